@@ -0,0 +1,193 @@
+# archive.py
+"""
+Streaming export and import of chat history.
+
+An archive is a gzip-compressed file of JSON lines: a header, the users, the
+messages in batches of ARCHIVE_BATCH_SIZE, and an end record with the totals so
+a truncated file is rejected instead of half-imported. Both directions stream
+one batch at a time, so memory use does not grow with the size of the history:
+
+    python archive.py export history.jsonl.gz --db peerchatdata.db
+    python archive.py import history.jsonl.gz --db peerchatdata.db
+
+Export reads everything in one read transaction, so the archive is a
+consistent snapshot even while the application is writing. Import loads all
+messages in one transaction with the message indexes rebuilt once at the end;
+messages and users that are already stored are kept as they are, and imported
+messages are added next to them. Attachment files are not included.
+"""
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+
+from database import DatabaseManagement
+
+ARCHIVE_FORMAT = "peertalk-history"
+ARCHIVE_VERSION = 1
+ARCHIVE_BATCH_SIZE = 1000  # messages per archive record
+COMPRESS_LEVEL = 6  # gzip level; higher is smaller but slower
+
+
+def export_records(db, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Yield the archive records for everything stored in a database.
+
+    Parameters:
+        db (DatabaseManagement): Database to read. It may be in use by the application.
+        batch_size (int): Maximum messages per record.
+
+    Yields:
+        dict: Archive records in file order.
+    """
+    snapshot = db.iter_snapshot(batch_size)
+    yield {'type': 'header', 'format': ARCHIVE_FORMAT, 'version': ARCHIVE_VERSION}
+    users = [[user_id, name, ip_address, port, connection_key]
+             for user_id, name, _, ip_address, port, connection_key in next(snapshot)]
+    yield {'type': 'users', 'rows': users}
+    count = 0
+    for rows in snapshot:
+        count += len(rows)
+        yield {'type': 'messages', 'rows': rows}
+    yield {'type': 'end', 'users': len(users), 'messages': count}
+
+
+def write_records(path, records, compress_level=COMPRESS_LEVEL):
+    """
+    Write records to a compressed archive as JSON lines.
+
+    Returns:
+        dict: The last record written, i.e. the end record with the totals.
+    """
+    record = None
+    # Write to a temporary name so a failed export never leaves a valid-looking archive
+    temp_path = f"{path}.tmp"
+    try:
+        with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=compress_level) as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")))
+                f.write("\n")
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    return record
+
+
+def read_records(path):
+    """
+    Yield the records of an archive, checking the header and that the file is complete.
+
+    Raises:
+        ValueError: If the file is not a history archive, is corrupt, or ends before its end record.
+        EOFError: If the compressed stream itself is cut off.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get('format') != ARCHIVE_FORMAT:
+            raise ValueError(f"{path} is not a history archive")
+        if header.get('version') != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported archive version: {header.get('version')}")
+        counts = {'users': 0, 'messages': 0}
+        for line in f:
+            record = json.loads(line)
+            if record.get('type') not in ('users', 'messages', 'end'):
+                raise ValueError(f"{path} is corrupt: unknown record {record.get('type')!r}")
+            if record['type'] == 'end':
+                if record['users'] != counts['users'] or record['messages'] != counts['messages']:
+                    raise ValueError(f"{path} is corrupt: record counts do not match")
+                return
+            counts[record['type']] += len(record['rows'])
+            yield record
+    raise ValueError(f"{path} is truncated")
+
+
+def export_archive(db, path, batch_size=ARCHIVE_BATCH_SIZE, compress_level=COMPRESS_LEVEL):
+    """
+    Export a database's history to an archive.
+
+    Parameters:
+        db (DatabaseManagement): Database to export. It may be in use by the application.
+        path (str): Archive file to write.
+        batch_size (int): Maximum messages per record.
+        compress_level (int): gzip compression level, 1-9.
+
+    Returns:
+        dict: {'users': <count>, 'messages': <count>}
+
+    Raises:
+        sqlite3.Error: If the database could not be read.
+    """
+    end = write_records(path, export_records(db, batch_size), compress_level)
+    return {'users': end['users'], 'messages': end['messages']}
+
+
+def import_archive(db, path):
+    """
+    Import an archive into a database. Nothing is imported if the archive is
+    incomplete or corrupt.
+
+    Parameters:
+        db (DatabaseManagement): Database to import into.
+        path (str): Archive file to read.
+
+    Returns:
+        dict: {'users': <new users>, 'messages': <new messages>}
+
+    Raises:
+        ValueError: If the archive is not a complete history archive.
+        EOFError: If the archive's compressed stream is cut off.
+        RuntimeError: If the database could not store the messages.
+    """
+    users = []
+
+    def message_batches():
+        for record in read_records(path):
+            if record['type'] == 'users':
+                users.extend(record['rows'])
+            else:
+                yield record['rows']
+
+    # Users are stored only after the messages load succeeded, i.e. the archive was complete
+    message_count = db.load_messages_bulk(message_batches())
+    if message_count is None:
+        raise RuntimeError("Could not store the messages; nothing was imported")
+    # Imported peers are not on this network yet
+    user_count = db.insert_users_bulk([
+        (user_id, name, False, ip_address, port, connection_key)
+        for user_id, name, ip_address, port, connection_key in users
+    ])
+    return {'users': user_count, 'messages': message_count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import PeerTalk chat history.")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("archive", help="archive file, e.g. history.jsonl.gz")
+    parser.add_argument("--db", default="peerchatdata.db", help="database file (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE,
+                        help="messages per archive record when exporting (default: %(default)s)")
+    parser.add_argument("--level", type=int, default=COMPRESS_LEVEL, choices=range(1, 10),
+                        help="gzip compression level when exporting (default: %(default)s)")
+    args = parser.parse_args()
+
+    db = DatabaseManagement(args.db)
+    if args.command == "export":
+        try:
+            counts = export_archive(db, args.archive, args.batch_size, args.level)
+        except (sqlite3.Error, OSError) as e:
+            parser.exit(1, f"Export failed: {e}\n")
+        print(f"Exported {counts['users']} users and {counts['messages']} messages to {args.archive}")
+    else:
+        try:
+            counts = import_archive(db, args.archive)
+        except EOFError:
+            parser.exit(1, f"Import failed: {args.archive} is truncated\n")
+        except (ValueError, KeyError, RuntimeError, OSError) as e:
+            parser.exit(1, f"Import failed: {e}\n")
+        print(f"Imported {counts['users']} new users and {counts['messages']} new messages from {args.archive}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+# assets.py
+import functools
+import os
+import customtkinter as ctk
+from PIL import Image
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Assets")
+
+
+@functools.lru_cache(maxsize=None)
+def load_icon(file_name, size=(20, 20)):
+    """
+    Decode an icon from the Assets folder the first time it is needed and cache it.
+
+    Parameters:
+        file_name (str): Image file name inside the Assets folder.
+        size (tuple): Display size (width, height) of the icon.
+
+    Returns:
+        CTkImage: The decoded icon, shared by every caller asking for the same size.
+    """
+    # PIL is already loaded by customtkinter; what is deferred is reading and decoding the file
+    with Image.open(os.path.join(ASSETS_DIR, file_name)) as image:
+        image.load()
+        return ctk.CTkImage(image.copy(), size=size)
@@ -0,0 +1,211 @@
+# attachments.py
+"""
+Content-addressed attachment store.
+
+Files are split into fixed-size chunks saved once under their SHA-256 hash, so
+an attachment sent to many peers, or received several times, takes its disk
+space once. The database tracks which chunks make up each attachment and how
+many messages use it; when the last message using an attachment is deleted,
+its unused chunks are removed from disk.
+
+Reads are memory-mapped, so sending or previewing an attachment never loads the
+whole file into Python memory:
+
+    with store.open(attachment_hash) as reader:
+        for view in reader.chunks():
+            sock.sendall(view)
+"""
+import hashlib
+import mmap
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024  # bytes per chunk
+
+
+class AttachmentReader:
+    """
+    Memory-mapped view of a stored attachment. Use as a context manager; views
+    handed out by chunks() are only valid until the reader is closed.
+    """
+    def __init__(self, paths_and_sizes):
+        self._chunks = paths_and_sizes  # (path, size) per chunk in file order
+        self._maps = []  # (memoryview, mmap) pairs handed out by chunks()
+        self.size = sum(size for _, size in paths_and_sizes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def chunks(self):
+        """
+        Yield a memoryview over each chunk in order, mapping chunk files as they are reached.
+        """
+        for path, size in self._chunks:
+            if size == 0:
+                continue
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            self._maps.append((view, mapped))
+            yield view
+
+    def read(self, offset, length):
+        """
+        Read a byte range, e.g. for a preview. Only the requested range is copied.
+
+        Parameters:
+            offset (int): Position of the first byte.
+            length (int): Maximum number of bytes to read.
+
+        Returns:
+            bytes: The requested range, shorter if it runs past the end.
+        """
+        parts = []
+        position = 0
+        for path, size in self._chunks:
+            if length <= 0:
+                break
+            if position + size <= offset or size == 0:
+                position += size
+                continue
+            start = max(0, offset - position)
+            end = min(size, start + length)
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                parts.append(mapped[start:end])
+            length -= end - start
+            position += size
+        return b"".join(parts)
+
+    def close(self):
+        for view, mapped in self._maps:
+            # A view the caller still holds would keep the mmap from closing
+            view.release()
+            mapped.close()
+        self._maps = []
+
+
+class AttachmentStore:
+    """
+    Stores attachment chunks under a directory and their metadata in the database.
+    """
+    def __init__(self, db, root, chunk_size=CHUNK_SIZE):
+        """
+        Parameters:
+            db (DatabaseManagement): Database holding attachment metadata and reference counts.
+            root (str): Directory the chunk files are kept in.
+            chunk_size (int): Bytes per chunk for newly stored files.
+        """
+        self.db = db
+        self.root = root
+        self.chunk_size = chunk_size
+        # Serializes recording chunks against deleting their files, see put()
+        self._chunk_lock = threading.Lock()
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        # Remove chunk files once deleting messages leaves them unused
+        db.chunk_release_hooks.append(self.delete_chunks)
+
+    def put(self, path):
+        """
+        Store a file, streaming it chunk by chunk. Chunks already on disk are not written again.
+        Link the returned hash to a message with DatabaseManagement.send_message(attachments=...)
+        so it is kept.
+
+        Parameters:
+            path (str): File to store.
+
+        Returns:
+            str: Content hash identifying the attachment.
+        """
+        file_hash = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                file_hash.update(data)
+                chunk_hash = hashlib.sha256(data).hexdigest()
+                self._write_chunk(chunk_hash, data)
+                chunks.append((chunk_hash, len(data)))
+                size += len(data)
+
+        attachment_hash = file_hash.hexdigest()
+        with self._chunk_lock:
+            self.db.add_attachment(attachment_hash, size, chunks)
+            # A message deleted meanwhile may have released a chunk this file shares and
+            # removed it after the write above skipped it; now that the chunk is recorded
+            # again, nothing removes it any more, so restore what is missing
+            with open(path, "rb") as f:
+                for idx, (chunk_hash, _) in enumerate(chunks):
+                    if not os.path.exists(self._chunk_path(chunk_hash)):
+                        f.seek(idx * self.chunk_size)
+                        data = f.read(self.chunk_size)
+                        if hashlib.sha256(data).hexdigest() == chunk_hash:  # Unless the file changed
+                            self._write_chunk(chunk_hash, data)
+        return attachment_hash
+
+    def open(self, attachment_hash):
+        """
+        Open a stored attachment for memory-mapped reading.
+
+        Parameters:
+            attachment_hash (str): Hash returned by put().
+
+        Returns:
+            AttachmentReader: Reader over the attachment's chunks.
+
+        Raises:
+            KeyError: If the attachment is not stored.
+        """
+        chunks = self.db.get_attachment_chunks(attachment_hash)
+        if chunks is None:
+            raise KeyError(attachment_hash)
+        return AttachmentReader([(self._chunk_path(chunk_hash), size) for chunk_hash, size in chunks])
+
+    def collect_garbage(self):
+        """
+        Remove attachments no message uses, e.g. files stored but never sent.
+        Only call this when no put() is waiting to be linked to a message.
+
+        Returns:
+            int: Number of chunk files removed.
+        """
+        return len(self.db.collect_unlinked_attachments())
+
+    def delete_chunks(self, chunk_hashes):
+        """Remove the files of chunks the database no longer references."""
+        with self._chunk_lock:
+            # A put() may have recorded a chunk again since it was released
+            referenced = self.db.get_referenced_chunks(chunk_hashes)
+            if referenced is None:
+                return  # Keeping an unused file is safer than losing a used one
+            for chunk_hash in chunk_hashes:
+                if chunk_hash not in referenced:
+                    self._remove_chunk(chunk_hash)
+
+    def _remove_chunk(self, chunk_hash):
+        try:
+            os.remove(self._chunk_path(chunk_hash))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("Error removing attachment chunk:", e)
+
+    def _chunk_path(self, chunk_hash):
+        # Fan out into subdirectories so no single directory grows too large
+        return os.path.join(self.root, "chunks", chunk_hash[:2], chunk_hash)
+
+    def _write_chunk(self, chunk_hash, data):
+        path = self._chunk_path(chunk_hash)
+        if os.path.exists(path):
+            return  # Same content is already stored
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)  # Readers never see a partial chunk
@@ -0,0 +1,328 @@
+# db_benchmark.py
+"""
+Benchmark DatabaseManagement on synthetic chat histories.
+
+Generates users and conversations of a configurable size, times every
+DatabaseManagement operation and prints a JSON report with ops/sec, latency
+percentiles, the database file size and peak memory, so runs before and after
+a schema or index change can be compared directly.
+
+Usage:
+    python benchmarks/db_benchmark.py --peers 50 --messages-per-peer 200
+    python benchmarks/db_benchmark.py --peers 500 --messages-per-peer 2000 --bulk-load --output run.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import mmap
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attachments import AttachmentStore
+from database import DatabaseManagement
+
+LOCAL_USER_ID = 'me'
+BULK_BATCH_SIZE = 1000  # messages per transaction when --bulk-load is used
+
+
+def parse_size_distribution(spec):
+    """
+    Build a message size sampler from a spec string.
+
+    Parameters:
+        spec (str): "fixed:N", "uniform:MIN-MAX" or "lognormal:MU,SIGMA" (sizes in characters).
+
+    Returns:
+        callable: Takes a random.Random and returns a message size.
+    """
+    kind, _, args = spec.partition(":")
+    if kind == "fixed":
+        size = int(args)
+        return lambda rng: size
+    if kind == "uniform":
+        low, high = (int(v) for v in args.split("-"))
+        return lambda rng: rng.randint(low, high)
+    if kind == "lognormal":
+        mu, sigma = (float(v) for v in args.split(","))
+        return lambda rng: max(1, int(rng.lognormvariate(mu, sigma)))
+    raise ValueError(f"Unknown size distribution: {spec}")
+
+
+def summarize(latencies, elapsed=None):
+    """
+    Summarize latencies in seconds as ops/sec and millisecond percentiles.
+    """
+    ordered = sorted(latencies)
+    count = len(ordered)
+    if not count:
+        return {"count": 0}
+
+    def percentile(percent):
+        return ordered[min(count - 1, max(0, math.ceil(count * percent / 100) - 1))] * 1000
+
+    total = sum(ordered)
+    return {
+        "count": count,
+        "ops_per_sec": count / (elapsed if elapsed is not None else total) if total else None,
+        "mean_ms": total / count * 1000,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def timed_calls(func, args_list):
+    """
+    Call func once per argument tuple and return each call's latency in seconds.
+    """
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    message_size = parse_size_distribution(args.size_distribution)
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="peertalk-bench-"), "bench.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    # DatabaseManagement prints its errors; keep them out of the JSON report
+    log = io.StringIO()
+    results = {}
+    with contextlib.redirect_stdout(log):
+        db = DatabaseManagement(db_path)
+        peer_ids = [f"peer-{i}" for i in range(args.peers)]
+
+        users = [
+            ({
+                'user_id': peer_id,
+                'name': f"Peer {i}",
+                'online': rng.random() < args.online_ratio,
+                'ip_address': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+                'port': 5000,
+                'connection_key': f"KEY{i}",
+            },)
+            for i, peer_id in enumerate(peer_ids)
+        ]
+        start = time.perf_counter()
+        results["add_or_update_user"] = summarize(timed_calls(db.add_or_update_user, users), time.perf_counter() - start)
+
+        # Interleave peers so conversations grow together, like a real history
+        sends = []
+        for _ in range(args.messages_per_peer):
+            for peer_id in peer_ids:
+                sender, receiver = (LOCAL_USER_ID, peer_id) if rng.random() < 0.5 else (peer_id, LOCAL_USER_ID)
+                sends.append((sender, receiver, "x" * message_size(rng)))
+
+        if args.bulk_load:
+            # Populate quickly through one transaction per batch, then time individual inserts on top
+            counters = {}
+            rows = []
+            for sender, receiver, content in sends:
+                seq = counters[(sender, receiver)] = counters.get((sender, receiver), 0) + 1
+                rows.append((sender, receiver, content, None, seq, None))
+            batches = [(rows[i:i + BULK_BATCH_SIZE],) for i in range(0, len(rows), BULK_BATCH_SIZE)]
+            start = time.perf_counter()
+            latencies = timed_calls(db.insert_messages_bulk, batches)
+            elapsed = time.perf_counter() - start
+            # Latencies are per batch; rows_per_sec is the load rate
+            results["insert_messages_bulk"] = summarize(latencies, elapsed)
+            results["insert_messages_bulk"]["rows_per_sec"] = len(rows) / elapsed if elapsed else None
+            sample = [rng.choice(sends) for _ in range(args.samples)]
+        else:
+            sample = sends
+        start = time.perf_counter()
+        results["send_message"] = summarize(timed_calls(db.send_message, sample), time.perf_counter() - start)
+
+        queries = {
+            "get_conversation": (db.get_conversation, lambda: (LOCAL_USER_ID, rng.choice(peer_ids))),
+            "get_messages_by_user": (db.get_messages_by_user, lambda: (rng.choice(peer_ids),)),
+            "get_user_by_id": (db.get_user_by_id, lambda: (rng.choice(peer_ids),)),
+            "get_online_users": (db.get_online_users, lambda: ()),
+            "get_all_users": (db.get_all_users, lambda: ()),
+            "update_user_status": (db.update_user_status, lambda: (rng.choice(peer_ids), rng.random() < 0.5)),
+            "get_high_water_marks": (db.get_high_water_marks, lambda: (LOCAL_USER_ID, rng.choice(peer_ids))),
+            # History sync of a peer that missed the last quarter of a conversation, read to the end
+            "iter_messages_after": (
+                lambda sender, receiver, after_seq: sum(len(batch) for batch in db.iter_messages_after(sender, receiver, after_seq)),
+                lambda: (rng.choice(peer_ids), LOCAL_USER_ID, args.messages_per_peer * 3 // 8)),
+        }
+        for name, (func, make_args) in queries.items():
+            calls = [make_args() for _ in range(args.samples)]
+            start = time.perf_counter()
+            results[name] = summarize(timed_calls(func, calls), time.perf_counter() - start)
+
+        # Inbound messages: new ones appended to the sender's seq, then the same ids redelivered
+        received = [(f"bench-{i}", rng.choice(peer_ids), LOCAL_USER_ID, "x" * message_size(rng)) for i in range(args.samples)]
+        for name in ("receive_message", "receive_message_duplicate"):
+            start = time.perf_counter()
+            results[name] = summarize(timed_calls(db.receive_message, received), time.perf_counter() - start)
+        lookups = [(uid if rng.random() < 0.5 else f"missing-{i}",) for i, (uid, *_) in enumerate(received)]
+        start = time.perf_counter()
+        results["message_exists"] = summarize(timed_calls(db.message_exists, lookups), time.perf_counter() - start)
+
+        new_users = [(f"bulk-peer-{i}", f"Bulk Peer {i}", False, "10.255.0.1", 5000, f"BULK{i}") for i in range(args.peers)]
+        user_batches = [(new_users[i:i + BULK_BATCH_SIZE],) for i in range(0, len(new_users), BULK_BATCH_SIZE)]
+        start = time.perf_counter()
+        results["insert_users_bulk"] = summarize(timed_calls(db.insert_users_bulk, user_batches), time.perf_counter() - start)
+
+        # An import of a twentieth of the history plus the received messages again, which it skips;
+        # one call, since every load rebuilds the indexes
+        stored = [(sender, receiver, content, None, None, uid) for uid, sender, receiver, content in received]
+        loaded = [(sender, receiver, content, None, None, f"import-{i}") for i, (sender, receiver, content) in
+                  enumerate(rng.sample(sends, min(len(sends), max(1, len(sends) // 20))))]
+        load_rows = stored + loaded
+        start = time.perf_counter()
+        db.load_messages_bulk(load_rows[i:i + BULK_BATCH_SIZE] for i in range(0, len(load_rows), BULK_BATCH_SIZE))
+        elapsed = time.perf_counter() - start
+        results["load_messages_bulk"] = summarize([elapsed])
+        results["load_messages_bulk"]["rows_per_sec"] = len(load_rows) / elapsed if elapsed else None
+
+        results.update(run_attachments(args, db, rng))
+
+        db_size = os.path.getsize(db_path)
+
+        # Destructive operations last so they do not shrink the data the queries ran against
+        message_ids = [row[0] for row in db.get_messages_by_user(LOCAL_USER_ID)]
+        to_delete = [(message_id,) for message_id in rng.sample(message_ids, min(args.samples, len(message_ids)))]
+        start = time.perf_counter()
+        results["delete_message"] = summarize(timed_calls(db.delete_message, to_delete), time.perf_counter() - start)
+
+        cleared = [(peer_id,) for peer_id in rng.sample(peer_ids, min(args.samples, len(peer_ids)))]
+        start = time.perf_counter()
+        results["clear_messages_by_user"] = summarize(timed_calls(db.clear_messages_by_user, cleared), time.perf_counter() - start)
+
+    report = {
+        "config": {
+            "peers": args.peers,
+            "messages_per_peer": args.messages_per_peer,
+            "size_distribution": args.size_distribution,
+            "online_ratio": args.online_ratio,
+            "samples": args.samples,
+            "bulk_load": args.bulk_load,
+            "seed": args.seed,
+        },
+        "dataset": {
+            "users": args.peers,
+            "messages": len(sends),
+            "db_size_bytes": db_size,
+        },
+        "operations": results,
+        "errors_logged": len(log.getvalue().splitlines()),
+    }
+    if args.trace_memory:
+        report["peak_traced_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    try:
+        import resource
+        # ru_maxrss is kilobytes on Linux and bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        report["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        pass  # Not available on Windows
+
+    if not args.db:
+        os.remove(db_path)
+        os.rmdir(os.path.dirname(db_path))
+    return report
+
+
+def run_attachments(args, db, rng):
+    """
+    Time storing, reading and collecting attachments. Half of them are linked to
+    messages, so collect_garbage has the other half to remove.
+
+    Returns:
+        dict: Operation name -> summary.
+    """
+    results = {}
+    files_dir = tempfile.mkdtemp(prefix="peertalk-bench-attachments-")
+    store = AttachmentStore(db, os.path.join(files_dir, "store"), chunk_size=args.chunk_size)
+    paths = []
+    for i in range(args.attachments):
+        path = os.path.join(files_dir, f"file-{i}.bin")
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(args.attachment_size))
+        paths.append((path,))
+
+    start = time.perf_counter()
+    latencies = []
+    hashes = []
+    for (path,) in paths:
+        call_start = time.perf_counter()
+        hashes.append(store.put(path))
+        latencies.append(time.perf_counter() - call_start)
+    results["attachment_put"] = summarize(latencies, time.perf_counter() - start)
+
+    def read_all(attachment_hash):
+        # Touch every page so the mapping is really read
+        with store.open(attachment_hash) as reader:
+            return sum(sum(view[::mmap.PAGESIZE]) for view in reader.chunks())
+
+    calls = [(rng.choice(hashes),) for _ in range(args.samples)]
+    start = time.perf_counter()
+    results["attachment_read"] = summarize(timed_calls(read_all, calls), time.perf_counter() - start)
+    start = time.perf_counter()
+    results["get_attachment_chunks"] = summarize(timed_calls(db.get_attachment_chunks, calls), time.perf_counter() - start)
+    chunk_lists = [([chunk_hash for chunk_hash, _ in db.get_attachment_chunks(attachment_hash)],) for (attachment_hash,) in calls]
+    start = time.perf_counter()
+    results["get_referenced_chunks"] = summarize(timed_calls(db.get_referenced_chunks, chunk_lists), time.perf_counter() - start)
+
+    linked = [(LOCAL_USER_ID, f"peer-{i % max(1, args.peers)}", "attachment", [attachment_hash])
+              for i, attachment_hash in enumerate(hashes[::2])]
+    start = time.perf_counter()
+    results["send_message_with_attachment"] = summarize(timed_calls(db.send_message, linked), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    store.collect_garbage()
+    results["collect_garbage"] = summarize([time.perf_counter() - start])
+    db.chunk_release_hooks.remove(store.delete_chunks)
+    shutil.rmtree(files_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DatabaseManagement on a synthetic chat history.")
+    parser.add_argument("--peers", type=int, default=50, help="number of peers (default: %(default)s)")
+    parser.add_argument("--messages-per-peer", type=int, default=200, help="messages per conversation (default: %(default)s)")
+    parser.add_argument("--size-distribution", default="lognormal:4,1",
+                        help='message size: "fixed:N", "uniform:MIN-MAX" or "lognormal:MU,SIGMA" (default: %(default)s)')
+    parser.add_argument("--online-ratio", type=float, default=0.5, help="fraction of peers marked online (default: %(default)s)")
+    parser.add_argument("--samples", type=int, default=200, help="calls timed per query/delete operation (default: %(default)s)")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="populate messages in bulk transactions and time --samples single inserts on top")
+    parser.add_argument("--attachments", type=int, default=20, help="attachment files stored (default: %(default)s)")
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024, help="bytes per attachment file (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024, help="attachment chunk size in bytes (default: %(default)s)")
+    parser.add_argument("--trace-memory", action="store_true", help="report peak Python allocations (slows the run)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    parser.add_argument("--db", help="database file to use and keep (default: a temporary file)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
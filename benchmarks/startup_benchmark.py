@@ -0,0 +1,77 @@
+# startup_benchmark.py
+"""
+Measure PeerTalk's time-to-first-frame.
+
+Each run starts a fresh interpreter so imports are timed cold, then reports
+how long importing gui.py, building ChatApp and drawing the first frame took.
+
+Usage:
+    python benchmarks/startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_once():
+    """
+    Start the app in this process and return its startup timings in seconds.
+    """
+    start = time.perf_counter()
+    sys.path.insert(0, REPO_DIR)
+    import gui
+
+    imported = time.perf_counter()
+    app = gui.ChatApp()
+    constructed = time.perf_counter()
+
+    # The first frame is on screen once the window is mapped and pending redraws have run
+    app.wait_visibility(app)
+    app.update()
+    first_frame = time.perf_counter()
+    app.destroy()
+
+    return {
+        "import_s": imported - start,
+        "construct_s": constructed - imported,
+        "first_frame_s": first_frame - start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure PeerTalk time-to-first-frame.")
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts to measure")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_once()))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    summary = {
+        key: {
+            "median": statistics.median(run[key] for run in runs),
+            "min": min(run[key] for run in runs),
+            "max": max(run[key] for run in runs),
+        }
+        for key in runs[0]
+    }
+    print(json.dumps({"runs": runs, "summary": summary}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# connections.py
+import asyncio
+import threading
+import time
+from models import ConnectionFailure
+from metrics import registry as metrics
+
+
+class ConnectionHandle:
+    """
+    Handle to a running connection attempt. The GUI can cancel it or wait for it.
+    """
+    def __init__(self, peer_id, future):
+        self.peer_id = peer_id
+        self._future = future
+
+    def cancel(self):
+        """Cancel the attempt. A cancelled attempt never reports a result."""
+        return self._future.cancel()
+
+    def cancelled(self):
+        return self._future.cancelled()
+
+    def done(self):
+        return self._future.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the attempt to finish.
+
+        Parameters:
+            timeout (float): Seconds to wait, or None to wait forever.
+
+        Returns:
+            ConnectionSuccess or ConnectionFailure.
+        """
+        return self._future.result(timeout)
+
+    def add_done_callback(self, callback):
+        self._future.add_done_callback(lambda future: callback(self))
+
+
+class ConnectionManager:
+    """
+    Runs all connection attempts as tasks on one asyncio event loop in a single
+    background thread. Attempts get a timeout, can be cancelled through their
+    handle, and a second request for a peer that is already being connected to
+    returns the existing handle instead of starting another attempt.
+    """
+    def __init__(self, on_result):
+        """
+        Parameters:
+            on_result (callable): Called with the ConnectionSuccess or ConnectionFailure
+                of every attempt that was not cancelled.
+        """
+        self.on_result = on_result
+        self.loop = None
+        self.pending = {}  # peer id -> ConnectionHandle of the running attempt
+        self._lock = threading.Lock()
+
+    def connect(self, peer_id, attempt, timeout):
+        """
+        Start connecting to a peer, or join an attempt that is already running.
+
+        Parameters:
+            peer_id (str): ID of the peer to connect to.
+            attempt (callable): Coroutine function taking peer_id and returning
+                ConnectionSuccess or ConnectionFailure.
+            timeout (float): Seconds before the attempt fails with a timeout.
+
+        Returns:
+            ConnectionHandle: Handle for the running attempt.
+        """
+        with self._lock:
+            handle = self.pending.get(peer_id)
+            if handle is not None and not handle.done():
+                return handle
+
+            future = asyncio.run_coroutine_threadsafe(self._run(peer_id, attempt, timeout), self._get_loop())
+            handle = ConnectionHandle(peer_id, future)
+            self.pending[peer_id] = handle
+        handle.add_done_callback(self._forget)
+        return handle
+
+    def close(self):
+        """Cancel every running attempt and stop the event loop."""
+        with self._lock:
+            for handle in self.pending.values():
+                handle.cancel()
+            self.pending = {}
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop = None
+
+    async def _run(self, peer_id, attempt, timeout):
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(attempt(peer_id), timeout)
+        except asyncio.TimeoutError:
+            result = ConnectionFailure("Connection timed out", peer_id=peer_id)
+        except asyncio.CancelledError:
+            metrics.counter("connections.cancelled").inc()
+            raise  # Cancelled attempts report nothing
+        except Exception as e:
+            result = ConnectionFailure(str(e) or type(e).__name__, peer_id=peer_id)
+        metrics.histogram("connections.attempt").record((time.perf_counter() - start) * 1_000_000)
+        self.on_result(result)
+        return result
+
+    def _forget(self, handle):
+        with self._lock:
+            if self.pending.get(handle.peer_id) is handle:
+                del self.pending[handle.peer_id]
+
+    def _get_loop(self):
+        # Called with the lock held; the loop thread is started on first use
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return self.loop
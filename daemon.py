@@ -0,0 +1,475 @@
+# daemon.py
+"""
+Headless PeerTalk service.
+
+Runs discovery, connections and persistence without a window and exposes them
+over a Unix domain socket, so the GUI and scripts can attach to one long-running
+process. The protocol is newline-delimited JSON:
+
+    request:  {"id": 1, "method": "send", "params": {"user_id": "1", "message": "hi"}}
+    response: {"id": 1, "result": null}   or   {"id": 1, "error": "..."}
+
+After a "subscribe" request the connection only streams events:
+
+    {"event": "peer_changes", "data": {...}}
+    {"event": "message", "data": {"peer_id": "1", "message_id": "...", "sender_id": "me", "content": "hi"}}
+
+Usage:
+    python daemon.py [--socket PATH] [--db FILE] [--no-discovery]
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import metrics
+from database import DatabaseManagement
+from models import ConnectionSuccess, ConnectionFailure, LocalAddress, Message, NewMessage, PeerChanges
+from registry import PeerSnapshot
+from service import ChatService, SEARCH_RESULT_LIMIT
+
+SUBSCRIBER_QUEUE_SIZE = 1000  # events buffered per subscriber before it is dropped as too slow
+
+
+def default_socket_path():
+    """Per-user socket path, preferring XDG_RUNTIME_DIR when it is set."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"peertalk-{os.getuid()}.sock")
+
+
+def event_to_dict(event):
+    """
+    Convert a service event into a JSON-serializable message.
+
+    Returns:
+        dict: {"event": <type>, "data": <payload>}, or None for unknown events.
+    """
+    if isinstance(event, PeerChanges):
+        return {"event": "peer_changes", "data": {
+            "added": event.added, "removed": event.removed, "changed": event.changed}}
+    if isinstance(event, ConnectionSuccess):
+        return {"event": "connection_success", "data": {"user": event.user}}
+    if isinstance(event, ConnectionFailure):
+        return {"event": "connection_failure", "data": {"peer_id": event.peer_id, "reason": event.reason}}
+    if isinstance(event, NewMessage):
+        message = event.message
+        return {"event": "message", "data": {
+            "peer_id": event.peer_id, "message_id": message.message_id,
+            "sender_id": message.sender_id, "content": message.content}}
+    if isinstance(event, LocalAddress):
+        return {"event": "local_address", "data": {"ip_address": event.ip_address}}
+    return None
+
+
+def dict_to_event(message):
+    """
+    Convert an event message from the daemon back into the service event it came from.
+
+    Returns:
+        The event object, or None for unknown events.
+    """
+    event, data = message.get("event"), message.get("data", {})
+    if event == "peer_changes":
+        return PeerChanges(added=data["added"], removed=data["removed"], changed=data["changed"])
+    if event == "connection_success":
+        return ConnectionSuccess(data["user"])
+    if event == "connection_failure":
+        return ConnectionFailure(data["reason"], peer_id=data["peer_id"])
+    if event == "message":
+        return NewMessage(data["peer_id"], Message(data["sender_id"], data["content"], data["message_id"]))
+    if event == "local_address":
+        return LocalAddress(data["ip_address"])
+    return None
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                method = request["method"]
+                params = request.get("params", {})
+            except (ValueError, KeyError, TypeError):
+                self._write({"id": None, "error": "Malformed request"})
+                continue
+
+            if method == "subscribe":
+                self._stream_events(request.get("id"))
+                return
+
+            try:
+                result = self.server.peertalk.dispatch(method, params)
+                self._write({"id": request.get("id"), "result": result})
+            except Exception as e:
+                self._write({"id": request.get("id"), "error": str(e) or type(e).__name__})
+
+    def _stream_events(self, request_id):
+        # Subscribe before confirming, so no event after the confirmation is missed
+        events = self.server.peertalk.add_subscriber()
+        try:
+            self._write({"id": request_id, "result": "subscribed"})
+            while True:
+                event = events.get()
+                if event is None:
+                    return  # Dropped or daemon shutting down
+                self._write(event)
+        except OSError:
+            pass  # Client went away
+        finally:
+            self.server.peertalk.remove_subscriber(events)
+
+    def _write(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class PeerTalkDaemon:
+    """
+    Owns a ChatService backed by the database and serves it to local clients.
+    """
+    def __init__(self, socket_path=None, db_name="peerchatdata.db", discovery=True):
+        """
+        Parameters:
+            socket_path (str): Path of the Unix domain socket to listen on.
+            db_name (str): SQLite database file used for persistence.
+            discovery (bool): Whether to start LAN peer discovery.
+        """
+        self.socket_path = socket_path or default_socket_path()
+        self.discovery = discovery
+        self.service = ChatService(ui_callback=self.publish, db=DatabaseManagement(db_name))
+        self.subscribers = []
+        self.attempts = {}  # peer id -> ConnectionHandle of the latest connect call
+        self._lock = threading.Lock()
+        self.server = None
+
+    def dispatch(self, method, params):
+        """
+        Run one API call against the service.
+
+        Parameters:
+            method (str): Name of the API method.
+            params (dict): Keyword arguments for the method.
+
+        Returns:
+            A JSON-serializable result.
+        """
+        service = self.service
+        if method == "send":
+            service.send_message(params["user_id"], params["message"])
+            return None
+        if method == "history":
+            return service.fetch_messages(params["user_id"], start=params.get("start", 0))
+        if method == "presence":
+            return [dict(user) for user in service.get_users()]
+        if method == "peers":
+            return [dict(user) for user in service.get_discovered_peers()]
+        if method == "search":
+            limit = params.get("limit", SEARCH_RESULT_LIMIT)
+            return [dict(user) for user in service.search_users(params["query"], limit)]
+        if method == "connect":
+            self.attempts[params["peer_id"]] = service.connect_to_peer(params["peer_id"])
+            return None  # The outcome arrives as a connection_* event
+        if method == "cancel_connect":
+            handle = self.attempts.pop(params["peer_id"], None)
+            return handle.cancel() if handle is not None else False
+        if method == "connection_code":
+            return service.get_connection_code(params["peer_id"])
+        if method == "start_discovery":
+            service.start_discovery()
+            return None
+        if method == "stop_discovery":
+            service.stop_discovery()
+            return None
+        if method == "local_address":
+            return service.local_ip  # None until detected; then a local_address event follows
+        if method == "metrics":
+            return metrics.registry.snapshot()
+        raise ValueError(f"Unknown method: {method}")
+
+    def publish(self, event):
+        """Forward a service event to every subscriber. Called from service threads."""
+        message = event_to_dict(event)
+        if message is None:
+            return
+        with self._lock:
+            for events in list(self.subscribers):
+                try:
+                    events.put_nowait(message)
+                except queue.Full:
+                    # Never let one slow client hold up the service
+                    self.subscribers.remove(events)
+                    self._close_queue(events)
+
+    def add_subscriber(self):
+        events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self.subscribers.append(events)
+        return events
+
+    def remove_subscriber(self, events):
+        with self._lock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
+
+    def serve_forever(self):
+        """
+        Start the service and answer clients until shutdown() is called.
+
+        Raises:
+            RuntimeError: If another daemon is already serving the socket path.
+        """
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.unlink(self.socket_path)  # Left behind by a previous run
+            else:
+                raise RuntimeError(f"Another daemon is already listening on {self.socket_path}")
+            finally:
+                probe.close()
+        # Create the socket with owner-only permissions, so no other user can connect
+        # in the window a chmod after bind would leave open
+        old_umask = os.umask(0o077)
+        try:
+            self.server = _Server(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.peertalk = self
+
+        self.service.resolve_local_ip()
+        if self.discovery:
+            self.service.start_discovery()
+        threading.Thread(target=self.service.run, daemon=True).start()
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def shutdown(self):
+        """Stop serving clients and stop the service."""
+        self.service.stop()
+        with self._lock:
+            for events in self.subscribers:
+                self._close_queue(events)
+            self.subscribers = []
+        if self.server is not None:
+            self.server.shutdown()
+
+    def _close_queue(self, events):
+        # Make room for the end-of-stream marker if the queue is full
+        while True:
+            try:
+                events.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class DaemonClient:
+    """
+    Client for a running PeerTalk daemon.
+
+    Example:
+        client = DaemonClient()
+        client.call("send", user_id="1", message="hello")
+        for event in DaemonClient().subscribe():
+            print(event)
+    """
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 1
+
+    def call(self, method, **params):
+        """
+        Call an API method and wait for its result.
+
+        Raises:
+            RuntimeError: If the daemon reports an error.
+        """
+        request_id = self.next_id
+        self.next_id += 1
+        self._send({"id": request_id, "method": method, "params": params})
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def subscribe(self):
+        """
+        Switch this connection to event streaming.
+
+        The daemon confirms the subscription before this returns, so every event
+        published afterwards is in the stream.
+
+        Returns:
+            iterator: Events as they arrive.
+        """
+        self.call("subscribe")
+        return (json.loads(line) for line in self.file)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def _send(self, message):
+        self.file.write(json.dumps(message).encode() + b"\n")
+        self.file.flush()
+
+
+class RemoteConnectionHandle:
+    """
+    Handle to a connection attempt running in the daemon. Its result arrives as an event.
+    """
+    def __init__(self, client, peer_id):
+        self.peer_id = peer_id
+        self._client = client
+
+    def cancel(self):
+        """Cancel the attempt. A cancelled attempt never reports a result."""
+        return self._client.call("cancel_connect", peer_id=self.peer_id)
+
+
+class RemoteChatService:
+    """
+    Stand-in for ChatService that forwards to a running daemon, so the GUI can
+    attach to it instead of running discovery, connections and the database
+    in its own process.
+
+    Calls use one DaemonClient connection and must all come from the same
+    thread (the Tk main loop). run() streams events over a second, subscribed
+    connection and passes them to ui_callback as the same objects ChatService
+    publishes. Peers are mirrored locally from peer_changes events, so reading
+    a snapshot never waits on the daemon.
+    """
+    def __init__(self, ui_callback, socket_path=None):
+        """
+        Parameters:
+            ui_callback (callable): Receives every event from the daemon. Called from run()'s thread.
+            socket_path (str): Path of the daemon's socket.
+
+        Raises:
+            OSError: If no daemon is listening on the socket.
+        """
+        self.ui_callback = ui_callback
+        self.socket_path = socket_path or default_socket_path()
+        self.client = DaemonClient(self.socket_path)
+        # Subscribe before loading the peers, so no change after the load is missed;
+        # replaying changes from before it only sets peers to states they already passed
+        self.events = DaemonClient(self.socket_path)
+        self.event_stream = self.events.subscribe()
+        self.local_ip = None
+        self._snapshot = PeerSnapshot(0, {user['id']: user for user in self.client.call("presence")})
+
+    def run(self):
+        """
+        Deliver events from the daemon until stop() is called or the daemon goes away.
+        """
+        try:
+            for message in self.event_stream:
+                event = dict_to_event(message)
+                if isinstance(event, PeerChanges):
+                    self._apply_peer_changes(event)
+                elif isinstance(event, LocalAddress):
+                    self.local_ip = event.ip_address
+                if event is not None:
+                    self.ui_callback(event)
+        except (OSError, ValueError):
+            pass  # Connection lost
+        finally:
+            self.events.close()
+        print("Disconnected from the PeerTalk daemon")
+
+    def stop(self):
+        """Disconnect from the daemon and let run() return. The daemon keeps running."""
+        try:
+            # Closing the stream while run() reads it would block; ending the connection wakes it
+            self.events.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already disconnected
+        self.client.close()
+
+    def _apply_peer_changes(self, changes):
+        # Every user in a change carries its full current state
+        by_id = dict(self._snapshot.by_id)
+        for user in changes.added + changes.removed + changes.changed:
+            by_id[user['id']] = user
+        self._snapshot = PeerSnapshot(self._snapshot.version + 1, by_id)
+
+    def get_peer_snapshot(self):
+        return self._snapshot
+
+    def get_users(self):
+        return list(self._snapshot.users)
+
+    def get_discovered_peers(self):
+        return list(self._snapshot.online)
+
+    def get_connection_code(self, peer_id):
+        return self._snapshot.by_id[peer_id]['connection_key']
+
+    def search_users(self, query, limit=SEARCH_RESULT_LIMIT):
+        return self.client.call("search", query=query, limit=limit)
+
+    def fetch_messages(self, user_id, start=0):
+        return self.client.call("history", user_id=user_id, start=start)
+
+    def send_message(self, user_id, message):
+        self.client.call("send", user_id=user_id, message=message)
+
+    def connect_to_peer(self, peer_id):
+        self.client.call("connect", peer_id=peer_id)
+        return RemoteConnectionHandle(self.client, peer_id)
+
+    def start_discovery(self):
+        self.client.call("start_discovery")
+
+    def stop_discovery(self):
+        self.client.call("stop_discovery")
+
+    def resolve_local_ip(self):
+        """
+        Report the daemon's local address as a LocalAddress event if it is already known;
+        otherwise it arrives as an event once the daemon has detected it.
+        """
+        self.local_ip = self.client.call("local_address")
+        if self.local_ip is not None:
+            self.ui_callback(LocalAddress(self.local_ip))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run PeerTalk as a headless background service.")
+    parser.add_argument("--socket", default=None, help="Unix socket path (default: peertalk-<uid>.sock in the runtime dir)")
+    parser.add_argument("--db", default="peerchatdata.db", help="SQLite database file")
+    parser.add_argument("--no-discovery", action="store_true", help="do not broadcast or listen for peers")
+    args = parser.parse_args()
+
+    metrics.configure_from_env()
+    daemon = PeerTalkDaemon(socket_path=args.socket, db_name=args.db, discovery=not args.no_discovery)
+    print(f"Starting PeerTalk daemon on {daemon.socket_path}")
+    try:
+        daemon.serve_forever()
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+    except KeyboardInterrupt:
+        daemon.service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,23 @@
 
 import sqlite3
+import metrics
+from metrics import timed
+
+# Outcomes of DatabaseManagement.receive_message
+RECEIVE_STORED = 'stored'
+RECEIVE_DUPLICATE = 'duplicate'
+RECEIVE_GAP = 'gap'  # An earlier message of the conversation is missing
+RECEIVE_FAILED = 'failed'
+
+def _log_error(message, error=None):
+    """
+    Report a database error and count it in the 'db.errors' metric.
+    """
+    if error is None:
+        print(message)
+    else:
+        print(message, error)
+    metrics.registry.counter("db.errors").inc()
 
 class DatabaseManagement:
     def __init__(self, db_name="peerchatdata.db"):
@@ -10,6 +28,7 @@ class DatabaseManagement:
             db_name (str): The name of the SQLite database file.
         """
         self.db_name = db_name
+        self.chunk_release_hooks = []  # Called with hashes of chunks no attachment uses any more
         self.setup_database()
 
     def setup_database(self):
@@ -19,6 +38,8 @@ class DatabaseManagement:
         try:
             conn = sqlite3.connect(self.db_name)
             cursor = conn.cursor()
+            # Readers and the writer do not block each other, so exports can run while chatting
+            cursor.execute('PRAGMA journal_mode=WAL')
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     id TEXT PRIMARY KEY,
@@ -36,16 +57,147 @@ class DatabaseManagement:
                     receiver_id TEXT NOT NULL,
                     content TEXT NOT NULL,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    seq INTEGER,
+                    uid TEXT,
                     FOREIGN KEY(sender_id) REFERENCES users(id),
                     FOREIGN KEY(receiver_id) REFERENCES users(id)
                 )
             ''')
+            # Content-addressed attachments: files are split into chunks stored once by hash,
+            # and refcount tracks how many messages (or attachments, for chunks) use each one
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS attachments (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chunks (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS attachment_chunks (
+                    attachment_hash TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    chunk_hash TEXT NOT NULL,
+                    PRIMARY KEY (attachment_hash, idx)
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS message_attachments (
+                    message_id INTEGER NOT NULL,
+                    attachment_hash TEXT NOT NULL,
+                    PRIMARY KEY (message_id, attachment_hash),
+                    FOREIGN KEY(message_id) REFERENCES messages(id)
+                )
+            ''')
+            self._migrate_message_seq(cursor)
+            self._migrate_message_uid(cursor)
+            self._create_message_indexes(cursor)
             conn.commit()
         except sqlite3.Error as e:
-            print("Database setup failed:", e)
+            _log_error("Database setup failed:", e)
         finally:
             conn.close()
 
+    def _create_message_indexes(self, cursor):
+        # seq counts each sender's messages per receiver, so sync can fetch gaps by range
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_conversation_seq
+            ON messages (sender_id, receiver_id, seq)
+        ''')
+        # uid is the global message id; the index makes redelivered messages no-ops
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_uid ON messages (uid)
+        ''')
+
+    def _migrate_message_seq(self, cursor):
+        """
+        Add the 'seq' column to databases created before it existed and number
+        their messages per sender and receiver in insertion order.
+        """
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+        if 'seq' in columns:
+            return
+        cursor.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+        cursor.execute('CREATE TEMP TABLE message_seq (id INTEGER PRIMARY KEY, seq INTEGER)')
+        cursor.execute('''
+            INSERT INTO message_seq (id, seq)
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY sender_id, receiver_id ORDER BY id)
+            FROM messages
+        ''')
+        cursor.execute('UPDATE messages SET seq = (SELECT seq FROM message_seq WHERE message_seq.id = messages.id)')
+        cursor.execute('DROP TABLE message_seq')
+
+    def _release_attachments(self, cursor, where, params):
+        """
+        Unlink attachments from the messages matching the WHERE clause, which are
+        about to be deleted, and drop attachments and chunks nothing uses any more.
+        Runs inside the caller's transaction.
+
+        Returns:
+            list: Hashes of chunks that are no longer referenced.
+        """
+        cursor.execute(f'''
+            SELECT attachment_hash, COUNT(*) FROM message_attachments
+            WHERE message_id IN (SELECT id FROM messages WHERE {where})
+            GROUP BY attachment_hash
+        ''', params)
+        released = cursor.fetchall()
+        if not released:
+            return []
+        cursor.execute(f'''
+            DELETE FROM message_attachments
+            WHERE message_id IN (SELECT id FROM messages WHERE {where})
+        ''', params)
+
+        touched_chunks = set()
+        for attachment_hash, count in released:
+            cursor.execute('UPDATE attachments SET refcount = refcount - ? WHERE hash = ?', (count, attachment_hash))
+            touched_chunks.update(self._drop_attachment_if_unused(cursor, attachment_hash))
+        return self._drop_unused_chunks(cursor, touched_chunks)
+
+    def _drop_attachment_if_unused(self, cursor, attachment_hash):
+        # Returns the chunk hashes whose refcount was lowered
+        cursor.execute('SELECT refcount FROM attachments WHERE hash = ?', (attachment_hash,))
+        row = cursor.fetchone()
+        if row is None or row[0] > 0:
+            return []
+        cursor.execute('SELECT chunk_hash FROM attachment_chunks WHERE attachment_hash = ?', (attachment_hash,))
+        chunk_hashes = [chunk_hash for (chunk_hash,) in cursor.fetchall()]
+        cursor.executemany('UPDATE chunks SET refcount = refcount - 1 WHERE hash = ?', [(h,) for h in chunk_hashes])
+        cursor.execute('DELETE FROM attachment_chunks WHERE attachment_hash = ?', (attachment_hash,))
+        cursor.execute('DELETE FROM attachments WHERE hash = ?', (attachment_hash,))
+        return chunk_hashes
+
+    def _drop_unused_chunks(self, cursor, chunk_hashes):
+        unused = []
+        for chunk_hash in chunk_hashes:
+            cursor.execute('SELECT refcount FROM chunks WHERE hash = ?', (chunk_hash,))
+            row = cursor.fetchone()
+            if row is not None and row[0] <= 0:
+                unused.append(chunk_hash)
+        cursor.executemany('DELETE FROM chunks WHERE hash = ?', [(h,) for h in unused])
+        return unused
+
+    def _run_chunk_release_hooks(self, chunk_hashes):
+        if chunk_hashes:
+            for hook in self.chunk_release_hooks:
+                hook(chunk_hashes)
+
+    def _migrate_message_uid(self, cursor):
+        """
+        Add the 'uid' column to databases created before it existed.
+        Older messages keep a NULL uid, which the unique index allows.
+        """
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+        if 'uid' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN uid TEXT')
+
     def _validate_user_data(self, user):
         """
         Validate that the required fields exist in the user dictionary and have correct types.
@@ -66,6 +218,7 @@ class DatabaseManagement:
         if not isinstance(user['port'], int):
             raise ValueError("Field 'port' must be an integer")
 
+    @timed("db.add_or_update_user")
     def add_or_update_user(self, user):
         """
         Add a new user or update an existing user's information in the database.
@@ -83,14 +236,15 @@ class DatabaseManagement:
             ''', (user['user_id'], user['name'], user['online'], user['ip_address'], user['port'], user['connection_key']))
             conn.commit()
         except ValueError as ve:
-            print("Validation Error:", ve)
+            _log_error("Validation Error:", ve)
         except sqlite3.IntegrityError:
-            print("Integrity error: Possibly a duplicate user ID.")
+            _log_error("Integrity error: Possibly a duplicate user ID.")
         except sqlite3.Error as e:
-            print("Error adding/updating user:", e)
+            _log_error("Error adding/updating user:", e)
         finally:
             conn.close()
 
+    @timed("db.get_all_users")
     def get_all_users(self):
         """
         Retrieve all users from the database.
@@ -105,11 +259,12 @@ class DatabaseManagement:
             users = cursor.fetchall()
             return users
         except sqlite3.Error as e:
-            print("Error retrieving users:", e)
+            _log_error("Error retrieving users:", e)
             return []
         finally:
             conn.close()
 
+    @timed("db.get_user_by_id")
     def get_user_by_id(self, user_id):
         """
         Retrieve a user from the database using their unique ID.
@@ -126,11 +281,12 @@ class DatabaseManagement:
             cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
             return cursor.fetchone()
         except sqlite3.Error as e:
-            print("Error retrieving user by ID:", e)
+            _log_error("Error retrieving user by ID:", e)
             return None
         finally:
             conn.close()
 
+    @timed("db.update_user_status")
     def update_user_status(self, user_id, status):
         """
         Update a user's online status.
@@ -147,13 +303,14 @@ class DatabaseManagement:
             cursor.execute('UPDATE users SET online = ? WHERE id = ?', (status, user_id))
             conn.commit()
         except ValueError as ve:
-            print("Validation Error:", ve)
+            _log_error("Validation Error:", ve)
         except sqlite3.Error as e:
-            print("Error updating user status:", e)
+            _log_error("Error updating user status:", e)
         finally:
             conn.close()
 
-    def send_message(self, sender_id, receiver_id, content):
+    @timed("db.send_message")
+    def send_message(self, sender_id, receiver_id, content, attachments=(), uid=None):
         """
         Insert a message into the messages table.
 
@@ -161,26 +318,115 @@ class DatabaseManagement:
             sender_id (str): ID of the sender.
             receiver_id (str): ID of the receiver.
             content (str): Text content of the message.
+            attachments (iterable): Hashes of stored attachments to link to the message.
+            uid (str): Globally unique message id, if the message has one.
+
+        Returns:
+            int: ID of the new message, or None if it could not be stored.
         """
         try:
             if not all([sender_id, receiver_id, content]):
                 raise ValueError("Sender, receiver, and content must not be empty")
             conn = sqlite3.connect(self.db_name)
             cursor = conn.cursor()
+            # The next seq is computed in the same statement so concurrent writers cannot reuse it
             cursor.execute('''
-                INSERT INTO messages (sender_id, receiver_id, content) 
-                VALUES (?, ?, ?)
-            ''', (sender_id, receiver_id, content))
+                INSERT INTO messages (sender_id, receiver_id, content, seq, uid)
+                VALUES (?, ?, ?, COALESCE(
+                    (SELECT MAX(seq) FROM messages WHERE sender_id = ? AND receiver_id = ?), 0) + 1, ?)
+            ''', (sender_id, receiver_id, content, sender_id, receiver_id, uid))
+            message_id = cursor.lastrowid
+            for attachment_hash in attachments:
+                cursor.execute('UPDATE attachments SET refcount = refcount + 1 WHERE hash = ?', (attachment_hash,))
+                if cursor.rowcount == 0:
+                    raise sqlite3.IntegrityError(f"Unknown attachment {attachment_hash}")
+                cursor.execute('''
+                    INSERT INTO message_attachments (message_id, attachment_hash) VALUES (?, ?)
+                ''', (message_id, attachment_hash))
             conn.commit()
+            return message_id
         except ValueError as ve:
-            print("Validation Error:", ve)
-        except sqlite3.IntegrityError:
-            print("Integrity error: Sender or receiver ID might not exist.")
+            _log_error("Validation Error:", ve)
+        except sqlite3.IntegrityError as e:
+            _log_error("Integrity error: Sender or receiver ID or attachment might not exist.", e)
         except sqlite3.Error as e:
-            print("Error sending message:", e)
+            _log_error("Error sending message:", e)
         finally:
             conn.close()
 
+    @timed("db.receive_message")
+    def receive_message(self, uid, sender_id, receiver_id, content, seq=None):
+        """
+        Store an inbound message unless a message with the same uid is already stored.
+
+        With a seq the message is only stored if it is the next one in its
+        conversation direction, so the seqs stay gapless for history sync. A
+        message that arrives ahead of a missing one is reported as RECEIVE_GAP
+        and not stored.
+
+        Parameters:
+            uid (str): Globally unique message id.
+            sender_id (str): ID of the sender.
+            receiver_id (str): ID of the receiver.
+            content (str): Text content of the message.
+            seq (int): The sender's seq for the message, or None to assign the next local one.
+
+        Returns:
+            str: RECEIVE_STORED, RECEIVE_DUPLICATE, RECEIVE_GAP, or RECEIVE_FAILED if
+                the message could not be stored and should be retried.
+        """
+        if not all([uid, sender_id, receiver_id, content]):
+            _log_error("Validation Error:", "Uid, sender, receiver, and content must not be empty")
+            return RECEIVE_FAILED
+        conn = None
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT COALESCE(MAX(seq), 0) FROM messages WHERE sender_id = ? AND receiver_id = ?
+            ''', (sender_id, receiver_id))
+            last_seq = cursor.fetchone()[0]
+            cursor.execute('SELECT 1 FROM messages WHERE uid = ?', (uid,))
+            if cursor.fetchone() is not None or (seq is not None and seq <= last_seq):
+                return RECEIVE_DUPLICATE
+            if seq is not None and seq > last_seq + 1:
+                return RECEIVE_GAP
+            cursor.execute('''
+                INSERT INTO messages (sender_id, receiver_id, content, seq, uid) VALUES (?, ?, ?, ?, ?)
+            ''', (sender_id, receiver_id, content, last_seq + 1, uid))
+            conn.commit()
+            return RECEIVE_STORED
+        except sqlite3.Error as e:
+            _log_error("Error receiving message:", e)
+            return RECEIVE_FAILED
+        finally:
+            if conn is not None:
+                conn.close()
+
+    @timed("db.message_exists")
+    def message_exists(self, uid):
+        """
+        Check whether a message with the given global id is stored.
+
+        Parameters:
+            uid (str): Globally unique message id.
+
+        Returns:
+            bool: True if the message is stored.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM messages WHERE uid = ?', (uid,))
+            return cursor.fetchone() is not None
+        except sqlite3.Error as e:
+            _log_error("Error checking message:", e)
+            return False
+        finally:
+            conn.close()
+
+    @timed("db.get_messages_by_user")
     def get_messages_by_user(self, user_id):
         """
         Get all messages where the given user is either the sender or the receiver.
@@ -195,15 +441,16 @@ class DatabaseManagement:
             conn = sqlite3.connect(self.db_name)
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT * FROM messages WHERE sender_id = ? OR receiver_id = ? ORDER BY timestamp ASC
+                SELECT * FROM messages WHERE sender_id = ? OR receiver_id = ? ORDER BY timestamp ASC, id ASC
             ''', (user_id, user_id))
             return cursor.fetchall()
         except sqlite3.Error as e:
-            print("Error retrieving messages for user:", e)
+            _log_error("Error retrieving messages for user:", e)
             return []
         finally:
             conn.close()
 
+    @timed("db.get_conversation")
     def get_conversation(self, user1_id, user2_id):
         """
         Get all messages exchanged between two users.
@@ -222,15 +469,16 @@ class DatabaseManagement:
                 SELECT * FROM messages 
                 WHERE (sender_id = ? AND receiver_id = ?) 
                 OR (sender_id = ? AND receiver_id = ?)
-                ORDER BY timestamp ASC
+                ORDER BY timestamp ASC, id ASC
             ''', (user1_id, user2_id, user2_id, user1_id))
             return cursor.fetchall()
         except sqlite3.Error as e:
-            print("Error retrieving conversation:", e)
+            _log_error("Error retrieving conversation:", e)
             return []
         finally:
             conn.close()
 
+    @timed("db.delete_message")
     def delete_message(self, message_id):
         """
         Delete a message from the database using its ID.
@@ -241,13 +489,16 @@ class DatabaseManagement:
         try:
             conn = sqlite3.connect(self.db_name)
             cursor = conn.cursor()
+            released_chunks = self._release_attachments(cursor, 'id = ?', (message_id,))
             cursor.execute('DELETE FROM messages WHERE id = ?', (message_id,))
             conn.commit()
+            self._run_chunk_release_hooks(released_chunks)
         except sqlite3.Error as e:
-            print("Error deleting message:", e)
+            _log_error("Error deleting message:", e)
         finally:
             conn.close()
 
+    @timed("db.get_online_users")
     def get_online_users(self):
         """
         Retrieve all users who are currently online.
@@ -261,11 +512,12 @@ class DatabaseManagement:
             cursor.execute('SELECT * FROM users WHERE online = 1')
             return cursor.fetchall()
         except sqlite3.Error as e:
-            print("Error retrieving online users:", e)
+            _log_error("Error retrieving online users:", e)
             return []
         finally:
             conn.close()
 
+    @timed("db.clear_all_messages")
     def clear_all_messages(self):
         """
         Delete all messages from the database.
@@ -273,13 +525,16 @@ class DatabaseManagement:
         try:
             conn = sqlite3.connect(self.db_name)
             cursor = conn.cursor()
+            released_chunks = self._release_attachments(cursor, '1 = 1', ())
             cursor.execute('DELETE FROM messages')
             conn.commit()
+            self._run_chunk_release_hooks(released_chunks)
         except sqlite3.Error as e:
-            print("Error clearing messages:", e)
+            _log_error("Error clearing messages:", e)
         finally:
             conn.close()
 
+    @timed("db.clear_messages_by_user")
     def clear_messages_by_user(self, user_id):
         """
         Delete all messages sent by a specific user.
@@ -290,9 +545,392 @@ class DatabaseManagement:
         try:
             conn = sqlite3.connect(self.db_name)
             cursor = conn.cursor()
+            released_chunks = self._release_attachments(cursor, 'sender_id = ?', (user_id,))
             cursor.execute('DELETE FROM messages WHERE sender_id = ?', (user_id,))
             conn.commit()
+            self._run_chunk_release_hooks(released_chunks)
+        except sqlite3.Error as e:
+            _log_error("Error clearing messages by user:", e)
+        finally:
+            conn.close()
+
+    @timed("db.get_high_water_marks")
+    def get_high_water_marks(self, user1_id, user2_id):
+        """
+        Get the highest message seq in each direction of a conversation.
+
+        Parameters:
+            user1_id (str): ID of the first user.
+            user2_id (str): ID of the second user.
+
+        Returns:
+            dict: {sender_id: highest seq} for both users; 0 when a user sent nothing.
+        """
+        marks = {user1_id: 0, user2_id: 0}
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            for sender_id, receiver_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                cursor.execute('''
+                    SELECT MAX(seq) FROM messages WHERE sender_id = ? AND receiver_id = ?
+                ''', (sender_id, receiver_id))
+                marks[sender_id] = cursor.fetchone()[0] or 0
+            return marks
+        except sqlite3.Error as e:
+            _log_error("Error retrieving high-water marks:", e)
+            return marks
+        finally:
+            conn.close()
+
+    def iter_messages_after(self, sender_id, receiver_id, after_seq, batch_size=500):
+        """
+        Yield the messages a sender sent to a receiver with seq above after_seq, in batches.
+        Each batch is a separate range scan on the seq index, so the cost depends
+        only on how many messages are returned.
+
+        Parameters:
+            sender_id (str): ID of the sender.
+            receiver_id (str): ID of the receiver.
+            after_seq (int): Only messages with a higher seq are returned.
+            batch_size (int): Maximum number of messages per batch.
+
+        Yields:
+            list: (sender_id, receiver_id, content, timestamp, seq, uid) tuples ordered by seq.
+        """
+        while True:
+            try:
+                conn = sqlite3.connect(self.db_name)
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT sender_id, receiver_id, content, timestamp, seq, uid FROM messages
+                    WHERE sender_id = ? AND receiver_id = ? AND seq > ?
+                    ORDER BY seq ASC LIMIT ?
+                ''', (sender_id, receiver_id, after_seq, batch_size))
+                batch = cursor.fetchall()
+            except sqlite3.Error as e:
+                _log_error("Error retrieving messages after seq:", e)
+                return
+            finally:
+                conn.close()
+            if not batch:
+                return
+            yield batch
+            after_seq = batch[-1][4]
+
+    @timed("db.insert_messages_bulk")
+    def insert_messages_bulk(self, messages):
+        """
+        Insert many messages in a single transaction, skipping ones already stored.
+
+        Parameters:
+            messages (list): (sender_id, receiver_id, content, timestamp, seq, uid) tuples.
+
+        Returns:
+            int: Number of messages actually inserted.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            before = conn.total_changes
+            # The unique seq and uid indexes turn repeats into no-ops
+            cursor.executemany('''
+                INSERT OR IGNORE INTO messages (sender_id, receiver_id, content, timestamp, seq, uid)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', messages)
+            conn.commit()
+            return conn.total_changes - before
+        except sqlite3.Error as e:
+            _log_error("Error inserting messages:", e)
+            return 0
+        finally:
+            conn.close()
+
+    def iter_snapshot(self, batch_size=1000):
+        """
+        Read every user and message from one consistent snapshot, streaming the
+        messages in batches. Everything is read in a single read transaction on
+        one connection, so writes made meanwhile by the application are not
+        seen and, in WAL mode, are not blocked.
+
+        Parameters:
+            batch_size (int): Maximum number of messages per batch.
+
+        Yields:
+            list: First all users as (id, name, online, ip_address, port, connection_key)
+                tuples, then batches of (sender_id, receiver_id, content, timestamp, seq, uid)
+                tuples in insertion order.
+
+        Raises:
+            sqlite3.Error: If reading fails, so a partial read is never mistaken for a full one.
+        """
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            cursor.execute('SELECT * FROM users')
+            yield cursor.fetchall()
+            cursor.execute('''
+                SELECT sender_id, receiver_id, content, timestamp, seq, uid FROM messages ORDER BY id
+            ''')
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+            cursor.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @timed("db.insert_users_bulk")
+    def insert_users_bulk(self, users):
+        """
+        Insert many users in a single transaction, keeping users already stored as they are.
+
+        Parameters:
+            users (list): (id, name, online, ip_address, port, connection_key) tuples.
+
+        Returns:
+            int: Number of users actually inserted.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            before = conn.total_changes
+            cursor.executemany('''
+                INSERT OR IGNORE INTO users (id, name, online, ip_address, port, connection_key)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', users)
+            conn.commit()
+            return conn.total_changes - before
+        except sqlite3.Error as e:
+            _log_error("Error inserting users:", e)
+            return 0
+        finally:
+            conn.close()
+
+    @timed("db.load_messages_bulk")
+    def load_messages_bulk(self, batches):
+        """
+        Load a large number of messages with deferred index builds, for imports.
+
+        The message indexes are dropped and the batches are inserted without
+        per-row index maintenance. Loaded messages that are already stored are
+        then removed: by uid, or by sender, receiver, content and timestamp for
+        messages without one. Loaded messages whose seq is taken by a different
+        stored message are renumbered after the end of their conversation. The
+        indexes are rebuilt once at the end. Stored messages are never changed.
+
+        Everything runs in one transaction, so a failure part way (including an
+        exception raised by the batches iterable) leaves the database unchanged.
+
+        Parameters:
+            batches (iterable): Lists of (sender_id, receiver_id, content, timestamp, seq, uid) tuples.
+                Consumed lazily, so it can be a generator over a file of any size.
+
+        Returns:
+            int: Number of messages actually inserted, or None if the load failed.
+        """
+        conn = None
+        try:
+            conn = sqlite3.connect(self.db_name, isolation_level=None)
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_conversation_seq')
+            cursor.execute('DROP INDEX IF EXISTS idx_messages_uid')
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+            last_stored_id = cursor.fetchone()[0]  # Loaded rows get higher ids
+            inserted = 0
+            for rows in batches:
+                cursor.executemany('''
+                    INSERT INTO messages (sender_id, receiver_id, content, timestamp, seq, uid)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', rows)
+                inserted += cursor.rowcount
+
+            # Repeats of stored messages, and of each other, keep only the first copy
+            cursor.execute('''
+                DELETE FROM messages WHERE id > ? AND uid IS NOT NULL AND id NOT IN (
+                    SELECT MIN(id) FROM messages WHERE uid IS NOT NULL GROUP BY uid
+                )
+            ''', (last_stored_id,))
+            inserted -= cursor.rowcount
+            # Messages from before uids existed can only be matched by what they say and when
+            cursor.execute('''
+                DELETE FROM messages WHERE id > ? AND uid IS NULL
+                AND (sender_id, receiver_id, content, timestamp) IN (
+                    SELECT sender_id, receiver_id, content, timestamp FROM messages
+                    WHERE id <= ? AND uid IS NULL
+                )
+            ''', (last_stored_id, last_stored_id))
+            inserted -= cursor.rowcount
+
+            # Different messages with a seq that is already taken move to the end of their conversation
+            cursor.execute('''
+                CREATE TEMP TABLE conversation_end AS
+                SELECT sender_id, receiver_id, MAX(seq) AS seq FROM messages GROUP BY sender_id, receiver_id
+            ''')
+            cursor.execute('CREATE TEMP TABLE message_seq (id INTEGER PRIMARY KEY, seq INTEGER)')
+            cursor.execute('''
+                INSERT INTO message_seq (id, seq)
+                SELECT m.id, e.seq + ROW_NUMBER() OVER (PARTITION BY m.sender_id, m.receiver_id ORDER BY m.id)
+                FROM messages m JOIN conversation_end e
+                    ON e.sender_id = m.sender_id AND e.receiver_id = m.receiver_id
+                WHERE m.id > ? AND (m.sender_id, m.receiver_id, m.seq) IN (
+                    SELECT sender_id, receiver_id, seq FROM messages WHERE id <= ?
+                )
+            ''', (last_stored_id, last_stored_id))
+            cursor.execute('''
+                UPDATE messages SET seq = (SELECT seq FROM message_seq WHERE message_seq.id = messages.id)
+                WHERE id IN (SELECT id FROM message_seq)
+            ''')
+            cursor.execute('DROP TABLE message_seq')
+            cursor.execute('DROP TABLE conversation_end')
+
+            self._create_message_indexes(cursor)
+            cursor.execute('COMMIT')
+            return inserted
+        except sqlite3.Error as e:
+            _log_error("Error loading messages:", e)
+            return None
+        finally:
+            if conn is not None:
+                conn.close()
+
+    @timed("db.add_attachment")
+    def add_attachment(self, attachment_hash, size, chunks):
+        """
+        Record a stored attachment and the chunks it is made of. Recording an
+        attachment that already exists does nothing.
+
+        Parameters:
+            attachment_hash (str): Content hash of the whole file.
+            size (int): File size in bytes.
+            chunks (list): (chunk_hash, chunk_size) tuples in file order.
+
+        Returns:
+            bool: True if the attachment was new.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO attachments (hash, size, refcount) VALUES (?, ?, 0)
+            ''', (attachment_hash, size))
+            if cursor.rowcount == 0:
+                return False
+            cursor.executemany('''
+                INSERT INTO attachment_chunks (attachment_hash, idx, chunk_hash) VALUES (?, ?, ?)
+            ''', [(attachment_hash, idx, chunk_hash) for idx, (chunk_hash, _) in enumerate(chunks)])
+            cursor.executemany('''
+                INSERT INTO chunks (hash, size, refcount) VALUES (?, ?, 1)
+                ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+            ''', chunks)
+            conn.commit()
+            return True
         except sqlite3.Error as e:
-            print("Error clearing messages by user:", e)
+            _log_error("Error adding attachment:", e)
+            return False
+        finally:
+            conn.close()
+
+    def get_referenced_chunks(self, chunk_hashes):
+        """
+        Find which of the given chunks are still used by some attachment.
+
+        Parameters:
+            chunk_hashes (list): Chunk hashes to check.
+
+        Returns:
+            set: The hashes that are still recorded, or None if the check failed.
+        """
+        conn = None
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            referenced = set()
+            for chunk_hash in chunk_hashes:
+                cursor.execute('SELECT 1 FROM chunks WHERE hash = ?', (chunk_hash,))
+                if cursor.fetchone() is not None:
+                    referenced.add(chunk_hash)
+            return referenced
+        except sqlite3.Error as e:
+            _log_error("Error checking chunks:", e)
+            return None
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def get_attachment_chunks(self, attachment_hash):
+        """
+        Get the chunks of a stored attachment in file order.
+
+        Parameters:
+            attachment_hash (str): Content hash of the attachment.
+
+        Returns:
+            list: (chunk_hash, chunk_size) tuples, or None if the attachment is unknown.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM attachments WHERE hash = ?', (attachment_hash,))
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('''
+                SELECT ac.chunk_hash, c.size FROM attachment_chunks AS ac
+                JOIN chunks AS c ON c.hash = ac.chunk_hash
+                WHERE ac.attachment_hash = ? ORDER BY ac.idx
+            ''', (attachment_hash,))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            _log_error("Error retrieving attachment chunks:", e)
+            return None
+        finally:
+            conn.close()
+
+    def get_message_attachments(self, message_id):
+        """
+        Get the hashes of the attachments linked to a message.
+
+        Parameters:
+            message_id (int): ID of the message.
+
+        Returns:
+            list: Attachment hashes.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute('SELECT attachment_hash FROM message_attachments WHERE message_id = ?', (message_id,))
+            return [attachment_hash for (attachment_hash,) in cursor.fetchall()]
+        except sqlite3.Error as e:
+            _log_error("Error retrieving message attachments:", e)
+            return []
+        finally:
+            conn.close()
+
+    @timed("db.collect_unlinked_attachments")
+    def collect_unlinked_attachments(self):
+        """
+        Drop attachments that were stored but never linked to a message, or whose
+        messages are gone, along with chunks nothing else uses.
+
+        Returns:
+            list: Hashes of chunks that are no longer referenced.
+        """
+        try:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute('SELECT hash FROM attachments WHERE refcount <= 0')
+            touched_chunks = set()
+            for (attachment_hash,) in cursor.fetchall():
+                touched_chunks.update(self._drop_attachment_if_unused(cursor, attachment_hash))
+            released_chunks = self._drop_unused_chunks(cursor, touched_chunks)
+            conn.commit()
+        except sqlite3.Error as e:
+            _log_error("Error collecting attachments:", e)
+            return []
         finally:
             conn.close()
+        self._run_chunk_release_hooks(released_chunks)
+        return released_chunks
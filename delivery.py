@@ -0,0 +1,166 @@
+# delivery.py
+"""
+Exactly-once delivery helpers: globally unique message ids and a bounded
+in-memory filter that drops redelivered messages without a database lookup.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+RECENT_IDS = 4096  # exact ids remembered for instant duplicate checks
+BLOOM_CAPACITY = 100_000  # ids per Bloom filter generation
+BLOOM_ERROR_RATE = 0.001  # false positive rate of each generation
+
+
+class MessageIdGenerator:
+    """
+    Creates time-ordered message ids of the form <ms timestamp><counter>-<node id>.
+
+    The millisecond timestamp and per-millisecond counter are monotonic even if
+    the clock steps back, and the node id keeps ids from different devices apart.
+    Ids sort by creation time when compared as strings.
+    """
+    def __init__(self, node_id):
+        """
+        Parameters:
+            node_id (str): Identifier unique to this device.
+        """
+        self.node_id = node_id
+        self._last_ms = 0
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            now_ms = time.time_ns() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._counter = 0
+            else:
+                # Same millisecond or clock went back: keep counting from the last id
+                self._counter += 1
+                if self._counter > 0xFFFF:
+                    self._last_ms += 1
+                    self._counter = 0
+            return f"{self._last_ms:012x}{self._counter:04x}-{self.node_id}"
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings. May report false positives, never false negatives.
+    """
+    def __init__(self, capacity, error_rate):
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = bits
+        self.hash_count = max(1, round(bits / capacity * math.log(2)))
+        self.bits = bytearray((bits + 7) // 8)
+        self.count = 0
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def _positions(self, item):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+
+class RotatingBloomFilter:
+    """
+    Two Bloom filter generations. When the current one is full it becomes the
+    previous one and a fresh filter takes its place, so memory stays bounded
+    while the most recent ids are always covered.
+    """
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+
+    def add(self, item):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+        self.current.add(item)
+
+    def __contains__(self, item):
+        return item in self.current or (self.previous is not None and item in self.previous)
+
+
+class MessageDeduplicator:
+    """
+    Decides whether an inbound message id was already delivered.
+
+    Retries usually repeat a message that just arrived, so the most recent ids
+    are kept in an exact LRU set and matched in O(1). Older ids are covered by a
+    rotating Bloom filter; since a Bloom hit can be a false positive, it is
+    confirmed against the database's unique index before the message is dropped.
+    Ids older than both are still caught by the unique index on insert.
+    """
+    def __init__(self, is_stored, recent_size=RECENT_IDS, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        """
+        Parameters:
+            is_stored (callable): Returns True if a message id is already in the database.
+            recent_size (int): Number of exact ids kept in memory.
+            capacity (int): Ids per Bloom filter generation.
+            error_rate (float): False positive rate of each Bloom filter generation.
+        """
+        self.is_stored = is_stored
+        self.recent_size = recent_size
+        self.recent = OrderedDict()
+        self.bloom = RotatingBloomFilter(capacity, error_rate)
+        self._lock = threading.Lock()
+
+    def check_and_add(self, message_id):
+        """
+        Check an inbound message id and remember it if it is new.
+
+        Parameters:
+            message_id (str): Globally unique id of the message.
+
+        Returns:
+            bool: True if the message was already delivered and should be dropped.
+        """
+        with self._lock:
+            if message_id in self.recent:
+                self.recent.move_to_end(message_id)
+                return True
+            if message_id not in self.bloom:
+                self._remember(message_id)
+                return False
+        # Possibly seen long ago, or a false positive: let the unique index decide
+        if self.is_stored(message_id):
+            return True
+        with self._lock:
+            self._remember(message_id)
+        return False
+
+    def add(self, message_id):
+        """Remember a message id that was stored without going through check_and_add."""
+        with self._lock:
+            self._remember(message_id)
+
+    def forget(self, message_id):
+        """
+        Undo check_and_add for a message that could not be stored, so its
+        redelivery is not dropped. The id may stay in the Bloom filter, whose
+        hits are confirmed against the database.
+        """
+        with self._lock:
+            self.recent.pop(message_id, None)
+
+    def _remember(self, message_id):
+        # Called with the lock held
+        self.recent[message_id] = None
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+        self.bloom.add(message_id)
@@ -0,0 +1,41 @@
+# events.py
+import queue
+
+
+class EventBus:
+    """
+    Thread-safe channel from background threads to the Tk main loop.
+
+    Worker threads (discovery, connection attempts) publish typed events such as
+    ConnectionSuccess or PeerChanges; the GUI drains them on its own thread, so
+    widgets are never touched from anywhere else.
+    """
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+
+    def publish(self, event):
+        """
+        Queue an event for the UI. Safe to call from any thread and never blocks.
+
+        Parameters:
+            event: The event object to deliver.
+        """
+        self._queue.put(event)
+
+    def drain(self, max_events):
+        """
+        Take up to max_events queued events without waiting.
+
+        Parameters:
+            max_events (int): Upper bound on events returned, so one drain cannot stall the UI.
+
+        Returns:
+            list: The events in the order they were published.
+        """
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
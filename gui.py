@@ -1,26 +1,44 @@
 # ui.py
+import argparse
 import threading
 import customtkinter as ctk
-from service import ChatService, ConnectionSuccess, ConnectionFailure
-from PIL import Image, ImageTk
-import tkinter as tk
+from service import ChatService, ConnectionSuccess, ConnectionFailure, PeerChanges, LocalAddress
 from models import User
-import socket
+from widgets import VirtualList, ChatHistory, get_font
+from events import EventBus
+from assets import load_icon
+import metrics
+from metrics import timed
 import time
 
-# Load icons
-home_icon_white = ctk.CTkImage(Image.open("Assets/homeIconWhite.png"), size=(20, 20))
-discover_icon_white = ctk.CTkImage(Image.open("Assets/discoverIconWhite.png"), size=(20, 20))
+CHAT_ROW_HEIGHT = 110  # pixels per row in the chat list
+CHAT_RENDER_WINDOW = 50  # bubbles rendered at once in the chat view
+SEARCH_DEBOUNCE_MS = 150  # pause in typing before the chat list is filtered
+EVENT_POLL_MS = 16  # how often background events are drained (about once per frame)
+EVENT_BATCH_SIZE = 100  # max events handled per drain so bursts cannot freeze the UI
 
 class ChatApp(ctk.CTk):
-    def __init__(self):
-        """Initialize the main window and all UI components."""
+    def __init__(self, daemon_socket=None):
+        """
+        Initialize the main window and all UI components.
+
+        Parameters:
+            daemon_socket (str): Socket of a running daemon to attach to, or None
+                to run the chat service inside this process.
+        """
         super().__init__()
         self.title("PeerTalk")
         self.geometry("800x600")
 
-        # Start the ChatService logic in a background thread
-        self.logic = ChatService(ui_callback=self.handle_logic_callback)
+        # Background threads report to the UI through the event bus only
+        self.events = EventBus()
+
+        # Start the ChatService logic in a background thread, or attach to the daemon's
+        if daemon_socket is None:
+            self.logic = ChatService(ui_callback=self.events.publish)
+        else:
+            from daemon import RemoteChatService
+            self.logic = RemoteChatService(ui_callback=self.events.publish, socket_path=daemon_socket)
         threading.Thread(target=self.logic.run, daemon=True).start()
 
         # Sidebar container for navigation buttons
@@ -28,14 +46,13 @@ class ChatApp(ctk.CTk):
         self.sidebar.pack(side="left", fill="y")
 
         # App title on the sidebar
-        self.project_label = ctk.CTkLabel(self.sidebar, text="PeerTalk", font=ctk.CTkFont(size=20, weight="bold"))
+        self.project_label = ctk.CTkLabel(self.sidebar, text="PeerTalk", font=get_font(20, "bold"))
         self.project_label.pack(pady=(30, 20))
 
         # Home button - shows list of chat users
         self.btn_home = ctk.CTkButton(
             self.sidebar,
             text="Home",
-            image=home_icon_white,
             command=self.show_chat_list,
             fg_color="transparent",
             corner_radius=20,
@@ -50,7 +67,6 @@ class ChatApp(ctk.CTk):
         self.btn_discover = ctk.CTkButton(
             self.sidebar,
             text="Discover",
-            image=discover_icon_white,
             command=self.show_discover_page,
             fg_color="transparent",
             corner_radius=20,
@@ -61,13 +77,16 @@ class ChatApp(ctk.CTk):
         )
         self.btn_discover.pack(pady=0)
 
-        # Top frame for search box and info button
+        # Top frame for search box and info button (packed by show_chat_list)
         self.top_frame = ctk.CTkFrame(self, fg_color="transparent", bg_color="transparent")
-        self.top_frame.pack(side="top", pady=20, padx=20)
+
+        # Frame that keeps the search box and info button centered
+        search_info_frame = ctk.CTkFrame(self.top_frame, fg_color="transparent", bg_color="transparent")
+        search_info_frame.pack(side="top", pady=20, anchor="center")
 
         # Search box for filtering users by name
         self.search_entry = ctk.CTkEntry(
-            self.top_frame,
+            search_info_frame,
             placeholder_text="Search",
             corner_radius=20,
             width=300,
@@ -75,12 +94,13 @@ class ChatApp(ctk.CTk):
             bg_color="transparent"
         )
         self.search_entry.pack(side="left", padx=(0, 10))
-        self.search_entry.bind("<Return>", lambda e: self.show_chat_list())  # Run search on Enter
+        self.search_entry.bind("<Return>", lambda e: self.filter_chat_list())  # Run search on Enter
+        self.search_entry.bind("<KeyRelease>", self.schedule_search)  # Search as you type
         self.search_entry.bind("<Escape>", lambda e: self.focus())  # Reset focus on Escape
 
         # Info button - opens info panel with local device details
         self.info_button = ctk.CTkButton(
-            self.top_frame,
+            search_info_frame,
             text="i",
             width=30,
             height=30,
@@ -92,25 +112,19 @@ class ChatApp(ctk.CTk):
         )
         self.info_button.pack(side="right")
 
-        # Info panel (hidden by default)
-        self.info_frame = ctk.CTkFrame(self, fg_color="#2b2b2b", corner_radius=10)
-        self.info_label = ctk.CTkLabel(self.info_frame, text="Device Name: Sample\nIP Address: 192.168.100.5")
-        self.info_label.pack(padx=10, pady=5)
-        self.info_frame.place_forget()  # Initially hidden
+        # Info panel (created on first toggle)
+        self.info_frame = None
 
         # Main frame for dynamic content (chat list, chat page, etc.)
         self.main_frame = ctk.CTkFrame(self)
         self.main_frame.pack(side="right", expand=True, fill="both")
 
-        # Get local IP address
-        local_ip = socket.gethostbyname(socket.gethostname())
-
-        # Create User object for the local device
+        # Create User object for the local device; its IP is detected in the background
         self.device_user = User(
             user_id="device_001",
             name="MyDevice",
             online=True,
-            ip_address=local_ip,
+            ip_address="Detecting...",
             port=5050,
             connection_key="some_key"
         )
@@ -120,14 +134,37 @@ class ChatApp(ctk.CTk):
         self.chat_page_frame = None
         self.discover_frame = None
         self.current_user = None
+        self.peer_buttons = {}  # peer id -> button in the available peers list
+        self.search_job = None  # Pending debounced search
+        self.chat_list_shown = None  # (peer registry version, query) currently in the chat list
+        self.pending_connection = None  # ConnectionHandle of the attempt being shown
 
         # Load the default chat list view
         self.show_chat_list()
 
+        # Start handling events from background threads on the Tk main loop
+        self.after(EVENT_POLL_MS, self.process_events)
+
+        # Work that is not needed for the first frame
+        self.logic.resolve_local_ip()
+        self.after_idle(self.load_sidebar_icons)
+
+    def load_sidebar_icons(self):
+        """
+        Decode the sidebar icons after the first frame has been drawn.
+        """
+        self.btn_home.configure(image=load_icon("homeIconWhite.png"))
+        self.btn_discover.configure(image=load_icon("discoverIconWhite.png"))
+
     def toggle_info_panel(self):
         """
         Toggle the visibility of the info panel that shows local user/device information.
         """
+        if self.info_frame is None:
+            self.info_frame = ctk.CTkFrame(self, fg_color="#2b2b2b", corner_radius=10)
+            self.info_label = ctk.CTkLabel(self.info_frame, text="")
+            self.info_label.pack(padx=10, pady=5)
+
         if self.info_frame.winfo_ismapped():
             # Hide the panel if it's already visible
             self.info_frame.place_forget()
@@ -161,121 +198,90 @@ class ChatApp(ctk.CTk):
     def show_chat_list(self):
         """
         Shows the chat list and restores the top bar (search box and info button).
-        Ensures the top frame is correctly placed at the top with elements centered.
+        The list page is built once and reused; only the visible rows are refreshed.
         """
+        self.cancel_connection()
         self.clear_main_frame()
-        
-        # Remove the top_frame from wherever it might be
-        self.top_frame.pack_forget()
-        
-        # Clear any existing widgets in the top frame
-        for widget in self.top_frame.winfo_children():
-            widget.pack_forget()
-        
-        # Create a center container within the top frame
-        center_container = ctk.CTkFrame(self.top_frame, fg_color="transparent", bg_color="transparent")
-        center_container.pack(expand=True, fill="x")
-        
-        # Create a frame for search and info that will be centered
-        search_info_frame = ctk.CTkFrame(center_container, fg_color="transparent", bg_color="transparent")
-        search_info_frame.pack(side="top", pady=20, anchor="center")
-        
-        # Search box
-        self.search_entry = ctk.CTkEntry(
-            search_info_frame,
-            placeholder_text="Search",
-            corner_radius=20,
-            width=300,
-            fg_color="transparent",
-            bg_color="transparent"
-        )
-        self.search_entry.pack(side="left", padx=(0, 10))
-        self.search_entry.bind("<Return>", lambda e: self.show_chat_list())
-        self.search_entry.bind("<Escape>", lambda e: self.focus())
-        
-        # Info button
-        self.info_button = ctk.CTkButton(
-            search_info_frame,
-            text="i",
-            width=30,
-            height=30,
-            corner_radius=30,
-            fg_color="#3498db",
-            hover_color="#2980b9",
-            text_color="white",
-            command=self.toggle_info_panel
-        )
-        self.info_button.pack(side="right")
-        
+
         # Ensure the top frame is properly placed at the top
         self.top_frame.pack(side="top", fill="x", before=self.main_frame)
 
-        search_query = self.search_entry.get().lower().strip()
-        all_users = self.logic.get_users()
+        if self.chat_users_frame is None:
+            self.chat_users_frame = VirtualList(
+                self.main_frame,
+                row_height=CHAT_ROW_HEIGHT,
+                create_row=self.create_chat_row,
+                bind_row=self.bind_chat_row
+            )
+        self.chat_users_frame.pack(expand=True, fill="both", padx=20, pady=20)
 
+        self.filter_chat_list()
+
+    def schedule_search(self, event=None):
+        """
+        Debounce search-as-you-type: run the search once typing pauses.
+        """
+        if event is not None and event.keysym in ("Return", "Escape"):
+            return  # Handled by their own bindings
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DEBOUNCE_MS, self.filter_chat_list)
+
+    @timed("gui.redraw.filter_chat_list")
+    def filter_chat_list(self):
+        """
+        Show the users matching the search box in the chat list.
+        """
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+            self.search_job = None
+
+        search_query = self.search_entry.get().strip()
+        snapshot = self.logic.get_peer_snapshot()
+        if (snapshot.version, search_query) == self.chat_list_shown:
+            return  # Nothing changed since the list was last drawn
 
         if search_query:
-            users = [user for user in all_users if search_query in user["name"].lower()]
+            users = self.logic.search_users(search_query)
         else:
-            users = all_users
-
-        canvas = tk.Canvas(self.main_frame, bg="#2b2b2b", highlightthickness=0)
-        canvas.pack(side="left", fill="both", expand=True, padx=20, pady=20)
+            users = list(snapshot.users)
 
-        scrollbar = ctk.CTkScrollbar(self.main_frame, orientation="vertical", command=canvas.yview)
-        scrollbar.pack(side="right", fill="y")
+        self.chat_users_frame.set_items(users)
+        self.chat_list_shown = (snapshot.version, search_query)
 
-        canvas.configure(yscrollcommand=scrollbar.set)
+    def create_chat_row(self, parent):
+        """
+        Create one reusable chat list row. Its contents are filled in by bind_chat_row.
+        """
+        row = ctk.CTkFrame(parent, fg_color="#2b2b2b", height=CHAT_ROW_HEIGHT)
 
-        scrollable_frame = ctk.CTkFrame(canvas, fg_color="#2b2b2b")
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
+        frame = ctk.CTkFrame(
+            row,
+            corner_radius=15,
+            fg_color="#3c3f41"  # Darker gray or any color you prefer
         )
+        frame.pack(fill="both", expand=True, pady=8, padx=10)
 
-        window_id = canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-
-        def on_canvas_resize(event):
-            canvas.itemconfig(window_id, width=event.width)
+        row.name_label = ctk.CTkLabel(frame, text="", font=get_font(16, "bold"))
+        row.name_label.pack(anchor="w", padx=10, pady=(8, 0))
 
-        canvas.bind("<Configure>", on_canvas_resize)
-
-        for user in users:
-            frame = ctk.CTkFrame(
-                scrollable_frame,
-                corner_radius=15,
-                fg_color="#3c3f41"  # Darker gray or any color you prefer
-            )
+        row.ip_label = ctk.CTkLabel(frame, text="", font=get_font(12), text_color="#bdc3c7")
+        row.ip_label.pack(anchor="w", padx=10, pady=(0, 8))
 
-            frame.pack(fill="x", expand=True, pady=8, padx=10)
+        row.chat_btn = ctk.CTkButton(frame, text="Open Chat", corner_radius=10, width=100)
+        row.chat_btn.pack(anchor="e", padx=10, pady=(0, 8))
+        return row
 
-            status_color = "#27ae60" if user["online"] else "#c0392b"
-            status_text = "Online" if user["online"] else "Offline"
-
-            name_label = ctk.CTkLabel(
-                frame,
-                text=f"{user['name']} ({status_text})",
-                font=ctk.CTkFont(size=16, weight="bold"),
-                text_color=status_color
-            )
-            name_label.pack(anchor="w", padx=10, pady=(8, 0))
+    def bind_chat_row(self, row, user):
+        """
+        Show the given user in a recycled chat list row.
+        """
+        status_color = "#27ae60" if user["online"] else "#c0392b"
+        status_text = "Online" if user["online"] else "Offline"
 
-            ip_label = ctk.CTkLabel(
-                frame,
-                text=f"IP: {user['ip_address']} • Port: {user['port']}",
-                font=ctk.CTkFont(size=12),
-                text_color="#bdc3c7"
-            )
-            ip_label.pack(anchor="w", padx=10, pady=(0, 8))
-
-            chat_btn = ctk.CTkButton(
-                frame,
-                text="Open Chat",
-                corner_radius=10,
-                width=100,
-                command=lambda u=user: self.open_chat(u)
-            )
-            chat_btn.pack(anchor="e", padx=10, pady=(0, 8))
+        row.name_label.configure(text=f"{user['name']} ({status_text})", text_color=status_color)
+        row.ip_label.configure(text=f"IP: {user['ip_address']} • Port: {user['port']}")
+        row.chat_btn.configure(command=lambda u=user: self.open_chat(u))
 
     def open_chat(self, user):
         """
@@ -312,7 +318,7 @@ class ChatApp(ctk.CTk):
         ctk.CTkLabel(
             top_bar,
             text=user['name'],
-            font=ctk.CTkFont(size=16, weight="bold"),
+            font=get_font(16, "bold"),
             text_color="white"
         ).pack(side="left", padx=10)
 
@@ -322,7 +328,7 @@ class ChatApp(ctk.CTk):
         ctk.CTkLabel(
             top_bar,
             text=status_text,
-            font=ctk.CTkFont(size=14),
+            font=get_font(14),
             text_color=status_color
         ).pack(side="left")
 
@@ -330,11 +336,7 @@ class ChatApp(ctk.CTk):
         chat_container = ctk.CTkFrame(self.chat_page_frame, fg_color="#2b2b2b")
         chat_container.pack(expand=True, fill="both", padx=20, pady=(0, 10))
 
-        self.chat_history_frame = ctk.CTkScrollableFrame(
-            chat_container,
-            fg_color="#2b2b2b",
-            corner_radius=10
-        )
+        self.chat_history_frame = ChatHistory(chat_container, peer_id=user['id'], window=CHAT_RENDER_WINDOW)
         self.chat_history_frame.pack(expand=True, fill="both")
 
         self.load_chat(user['id'])
@@ -375,39 +377,14 @@ class ChatApp(ctk.CTk):
         )
         self.send_button.pack(side="right", padx=(5, 5), pady=10)
 
+    @timed("gui.redraw.load_chat")
     def load_chat(self, user_id):
         """
-        Loads chat messages for the given user ID into the chat history frame.
-        Aligns messages to left or right based on sender.
+        Appends messages for the given user ID that are not shown yet to the chat history.
+        Bubbles already on screen are kept, so each call only renders new messages.
         """
-        # Clear previous messages
-        for widget in self.chat_history_frame.winfo_children():
-            widget.destroy()
-
-        # Fetch message history from logic
-        messages = self.logic.fetch_messages(user_id)
-
-        for msg in messages:
-            is_from_user = msg['from'] == user_id
-            side = "w" if is_from_user else "e"
-            bg_color = "#34495e" if is_from_user else "#16a085"
-            text_color = "white"
-
-            # Message bubble style
-            bubble = ctk.CTkLabel(
-                self.chat_history_frame,
-                text=msg['message'],
-                anchor=side,
-                justify="left",
-                wraplength=500,
-                font=ctk.CTkFont(size=13),
-                text_color=text_color,
-                fg_color=bg_color,
-                corner_radius=12,
-                padx=10,
-                pady=6
-            )
-            bubble.pack(anchor=side, padx=10, pady=4)
+        rendered = len(self.chat_history_frame.messages)
+        self.chat_history_frame.append(self.logic.fetch_messages(user_id, start=rendered))
 
     def toggle_send_upload_buttons(self, event=None):
         text = self.message_entry.get()
@@ -429,14 +406,28 @@ class ChatApp(ctk.CTk):
     def upload_file(self):
         print("Upload file clicked")
 
+    def process_events(self):
+        """
+        Drain a bounded batch of events published by background threads and
+        handle them on the main thread, then schedule the next drain.
+        """
+        try:
+            for event in self.events.drain(EVENT_BATCH_SIZE):
+                self.handle_logic_callback(event)
+        finally:
+            self.after(EVENT_POLL_MS, self.process_events)
+
     def handle_logic_callback(self, result=None):
         if isinstance(result, ConnectionSuccess):
-            self.open_chat(result.user)
+            if self.is_pending_result(result.user['id']):
+                self.open_chat(result.user)
         elif isinstance(result, ConnectionFailure):
-            self.show_connection_failure(result.reason)
-        elif result == 'peer_discovered':
-            # Refresh UI from main thread
-            self.after(100, self.refresh_peers)
+            if self.is_pending_result(result.peer_id):
+                self.show_connection_failure(result.reason)
+        elif isinstance(result, PeerChanges):
+            self.apply_peer_changes(result)
+        elif isinstance(result, LocalAddress):
+            self.device_user.ip_address = result.ip_address
 
     def show_connection_failure(self, reason):
         self.clear_main_frame()
@@ -447,9 +438,13 @@ class ChatApp(ctk.CTk):
 
     def clear_main_frame(self):
         for widget in self.main_frame.winfo_children():
-            widget.destroy()
+            if widget is self.chat_users_frame:
+                widget.pack_forget()  # Kept alive so its rows can be reused
+            else:
+                widget.destroy()
 
     def show_discover_page(self):
+        self.cancel_connection()
         self.clear_main_frame()
         self.discover_frame = ctk.CTkFrame(self.main_frame)
         self.discover_frame.pack(expand=True, fill="both")
@@ -472,6 +467,7 @@ class ChatApp(ctk.CTk):
 
         self.available_label = ctk.CTkLabel(self.discover_frame, text="Available Peers")
         self.available_list_frame = ctk.CTkFrame(self.discover_frame)
+        self.peer_buttons = {}
 
     def start_discovery_session(self):
      if getattr(self, 'discovery_timer_active', False):
@@ -499,24 +495,54 @@ class ChatApp(ctk.CTk):
             self.available_label.pack_forget()
             self.available_list_frame.pack_forget()
 
+    @timed("gui.redraw.refresh_peers")
     def refresh_peers(self):
-     self.logic.stop_discovery()
-     self.logic.start_discovery()
-
+     # Only re-read the peers; restarting discovery would race the old listener for the port
      self.available_label.configure(text="Discovering peers...")
      self.start_discovery_session()
      for widget in self.available_list_frame.winfo_children():
         widget.destroy()
+     self.peer_buttons = {}
 
-     peers = self.logic.get_discovered_peers()
-     if peers:
-        self.available_label.configure(text="Available Peers:")
-     else:
-        if not getattr(self, 'discovery_timer_active', False):
-            self.available_label.configure(text="No peers found ❌")
+     for peer in self.logic.get_discovered_peers():
+        self.add_peer_button(peer)
+     self.update_available_label()
+
+    def add_peer_button(self, peer):
+        button = ctk.CTkButton(self.available_list_frame, text=peer['name'], command=lambda p=peer: self.show_connecting_ui(p))
+        button.pack(pady=5, padx=10, anchor="w")
+        self.peer_buttons[peer['id']] = button
+
+    @timed("gui.redraw.apply_peer_changes")
+    def apply_peer_changes(self, changes):
+        """
+        Apply a batched peer diff to the available peers list without rebuilding it.
+        """
+        if self.discover_frame is None or not self.discover_frame.winfo_exists():
+            return  # Discover page not shown; it reads fresh peers when opened
+
+        for peer in changes.removed:
+            button = self.peer_buttons.pop(peer['id'], None)
+            if button:
+                button.destroy()
+
+        for peer in changes.added + changes.changed:
+            button = self.peer_buttons.get(peer['id'])
+            if not peer['online']:
+                if button:
+                    self.peer_buttons.pop(peer['id']).destroy()
+            elif button:
+                button.configure(text=peer['name'], command=lambda p=peer: self.show_connecting_ui(p))
+            else:
+                self.add_peer_button(peer)
 
-     for peer in peers:
-        ctk.CTkButton(self.available_list_frame, text=peer['name'], command=lambda p=peer: self.show_connecting_ui(p)).pack(pady=5, padx=10, anchor="w")
+        self.update_available_label()
+
+    def update_available_label(self):
+     if self.peer_buttons:
+        self.available_label.configure(text="Available Peers:")
+     elif not getattr(self, 'discovery_timer_active', False):
+        self.available_label.configure(text="No peers found ❌")
 
     def enter_peer_manually(self):
         dialog = ctk.CTkInputDialog(text="Enter IP Address:", title="Manual Connection")
@@ -540,7 +566,25 @@ class ChatApp(ctk.CTk):
 
         ctk.CTkButton(request_frame, text="Cancel", command=self.show_discover_page).pack(pady=10)
 
-        threading.Thread(target=self.logic.connect_to_peer, args=(peer['id'],), daemon=True).start()
+        self.pending_connection = self.logic.connect_to_peer(peer['id'])
+
+    def cancel_connection(self):
+        """
+        Cancel the connection attempt in progress, if any, so it can no longer open a chat.
+        """
+        if self.pending_connection is not None:
+            self.pending_connection.cancel()
+            self.pending_connection = None
+
+    def is_pending_result(self, peer_id):
+        """
+        Check whether a connection result belongs to the attempt the user is waiting on.
+        Results of cancelled or superseded attempts may still be queued and are ignored.
+        """
+        if self.pending_connection is None or self.pending_connection.peer_id != peer_id:
+            return False
+        self.pending_connection = None
+        return True
 
     def check_discovery_timeout(self):
      if not getattr(self, 'discovery_timer_active', False):
@@ -561,5 +605,14 @@ class ChatApp(ctk.CTk):
         self.after(500, self.check_discovery_timeout)
 
 if __name__ == '__main__':
-    app = ChatApp()
+    parser = argparse.ArgumentParser(description="PeerTalk chat window.")
+    parser.add_argument("--daemon", nargs="?", const="", default=None, metavar="SOCKET",
+                        help="attach to a running daemon (default socket if none is given)")
+    args = parser.parse_args()
+
+    metrics.configure_from_env()
+    try:
+        app = ChatApp(daemon_socket=args.daemon)
+    except OSError as e:
+        parser.exit(1, f"Could not attach to the daemon: {e}\n")
     app.mainloop()
@@ -0,0 +1,262 @@
+# metrics.py
+"""
+Lightweight in-process metrics: counters, gauges and latency histograms.
+
+Metrics are disabled unless PEERTALK_METRICS=1 is set or enable() is called.
+While disabled every instrument returns immediately, so instrumented hot paths
+cost one attribute check. Snapshots are plain dicts that can be returned from
+an API or dumped to a JSON file periodically (PEERTALK_METRICS_DUMP=<path>).
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+HISTOGRAM_SUB_BUCKET_BITS = 7  # 2**7 sub-buckets per power of two: under 1% relative error
+DUMP_INTERVAL = 10  # seconds between periodic JSON dumps
+
+
+class Counter:
+    def __init__(self, registry):
+        self._registry = registry
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self, registry):
+        self._registry = registry
+        self.value = 0
+
+    def set(self, value):
+        if self._registry.enabled:
+            self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    HDR-style latency histogram over integer microseconds.
+
+    Values are grouped into log-linear buckets: every power of two is split into
+    2**HISTOGRAM_SUB_BUCKET_BITS equal buckets, so memory stays small while
+    percentiles keep a fixed relative precision from microseconds to minutes.
+    """
+    def __init__(self, registry):
+        self._registry = registry
+        self._lock = threading.Lock()
+        self.buckets = {}  # bucket lower bound (us) -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, micros):
+        """
+        Record one value.
+
+        Parameters:
+            micros (int): The measured latency in microseconds.
+        """
+        if not self._registry.enabled:
+            return
+        micros = max(0, int(micros))
+        # Keep the leading 1 plus HISTOGRAM_SUB_BUCKET_BITS bits below it
+        shift = max(0, micros.bit_length() - (HISTOGRAM_SUB_BUCKET_BITS + 1))
+        bucket = (micros >> shift) << shift
+        with self._lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += micros
+            self.min = micros if self.min is None else min(self.min, micros)
+            self.max = micros if self.max is None else max(self.max, micros)
+
+    def time(self):
+        """Context manager that records how long its block took."""
+        if not self._registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self)
+
+    def percentile(self, percent):
+        """
+        Return the value below which the given percentage of recordings fall.
+
+        Parameters:
+            percent (float): Percentile between 0 and 100.
+
+        Returns:
+            int: Bucket lower bound in microseconds, or None if nothing was recorded.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            target = max(1, round(self.count * percent / 100))
+            seen = 0
+            for bucket in sorted(self.buckets):
+                seen += self.buckets[bucket]
+                if seen >= target:
+                    return bucket
+            return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'min_us': self.min,
+            'mean_us': self.total / self.count if self.count else None,
+            'p50_us': self.percentile(50),
+            'p90_us': self.percentile(90),
+            'p99_us': self.percentile(99),
+            'p999_us': self.percentile(99.9),
+            'max_us': self.max,
+        }
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.record((time.perf_counter() - self.start) * 1_000_000)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class MetricsRegistry:
+    """
+    Named collection of metrics. Instruments are created on first use and live for the process.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._dump_thread = None
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def time(self, name):
+        """Context manager recording the duration of its block into the named histogram."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.histogram(name))
+
+    def snapshot(self):
+        """
+        Return the current value of every metric.
+
+        Returns:
+            dict: {'timestamp': ..., 'counters': {...}, 'gauges': {...}, 'histograms': {...}}
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        snapshot = {'timestamp': time.time(), 'counters': {}, 'gauges': {}, 'histograms': {}}
+        for name, metric in sorted(metrics.items()):
+            kind = {Counter: 'counters', Gauge: 'gauges', Histogram: 'histograms'}[type(metric)]
+            snapshot[kind][name] = metric.snapshot()
+        return snapshot
+
+    def start_periodic_dump(self, path, interval=DUMP_INTERVAL):
+        """
+        Write a JSON snapshot to path every interval seconds from a background thread.
+        The file is replaced atomically so readers never see a partial dump.
+        """
+        if self._dump_thread is not None:
+            return
+
+        def dump_forever():
+            while True:
+                time.sleep(interval)
+                temp_path = f"{path}.tmp"
+                try:
+                    with open(temp_path, "w") as f:
+                        json.dump(self.snapshot(), f, indent=2)
+                    os.replace(temp_path, path)
+                except OSError as e:
+                    # E.g. a full disk or a removed directory; try again next interval
+                    print("Error writing metrics dump:", e)
+
+        self._dump_thread = threading.Thread(target=dump_forever, daemon=True)
+        self._dump_thread.start()
+
+    def _get(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, kind(self))
+        if not isinstance(metric, kind):
+            raise ValueError(f"Metric {name} is a {type(metric).__name__}, not a {kind.__name__}")
+        return metric
+
+
+registry = MetricsRegistry(enabled=os.environ.get("PEERTALK_METRICS") == "1")
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    registry.enabled = False
+
+
+def configure_from_env():
+    """
+    Start the periodic JSON dump if PEERTALK_METRICS_DUMP names a file.
+    Setting a dump file also enables metrics.
+    """
+    path = os.environ.get("PEERTALK_METRICS_DUMP")
+    if path:
+        enable()
+        registry.start_periodic_dump(path)
+
+
+def timed(name):
+    """
+    Decorator recording each call's duration into the named histogram.
+    When metrics are disabled the only cost is one flag check per call.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            with _Timer(registry.histogram(name)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
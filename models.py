@@ -3,13 +3,24 @@ class ConnectionSuccess:
         self.user = user
 
 class ConnectionFailure:
-    def __init__(self, reason):
+    def __init__(self, reason, peer_id=None):
         self.reason = reason
+        self.peer_id = peer_id
+
+class LocalAddress:
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
 
 class Message:
-    def __init__(self, sender_id, content):
+    def __init__(self, sender_id, content, message_id=None):
         self.sender_id = sender_id
         self.content = content
+        self.message_id = message_id
+
+class NewMessage:
+    def __init__(self, peer_id, message):
+        self.peer_id = peer_id  # Peer whose conversation the message belongs to
+        self.message = message
 
 class User:
     def __init__(self, user_id, name, online, ip_address, port, connection_key):
@@ -29,4 +40,13 @@ class User:
             'ip_address': self.ip_address,
             'port': self.port,
             'connection_key': self.connection_key
-        }
\ No newline at end of file
+        }
+
+class PeerChanges:
+    def __init__(self, added=None, removed=None, changed=None):
+        self.added = added or []
+        self.removed = removed or []
+        self.changed = changed or []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
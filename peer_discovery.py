@@ -2,11 +2,16 @@
 import socket
 import threading
 import time
+from metrics import registry as metrics
 
 BROADCAST_PORT = 50000
 BROADCAST_INTERVAL = 3  # seconds
+PEER_TIMEOUT = 3 * BROADCAST_INTERVAL  # seconds of silence before a peer is considered gone
 DISCOVERY_MESSAGE = b"PeerTalk::hello"
 
+_own_ip = None
+_own_ip_lock = threading.Lock()
+
 def get_own_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -17,11 +22,24 @@ def get_own_ip():
     finally:
         s.close()
 
+def get_local_ip():
+    """
+    Return this machine's LAN address, detecting it only once per process.
+    May block on the first call, so call it from a background thread.
+    """
+    global _own_ip
+    with _own_ip_lock:
+        if _own_ip is None:
+            _own_ip = get_own_ip()
+        return _own_ip
+
 class PeerDiscovery:
-    def __init__(self, on_peer_found):
+    def __init__(self, on_peer_found, on_peer_lost=None):
         self.running = True
-        self.own_ip = get_own_ip()
+        self.own_ip = None  # Resolved by the listener thread, off the caller's thread
         self.on_peer_found = on_peer_found
+        self.on_peer_lost = on_peer_lost
+        self.last_seen = {}  # ip -> time of last hello
 
     def start(self):
         threading.Thread(target=self.broadcast_presence, daemon=True).start()
@@ -32,13 +50,35 @@ class PeerDiscovery:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         while self.running:
             sock.sendto(DISCOVERY_MESSAGE, ('<broadcast>', BROADCAST_PORT))
+            metrics.counter("discovery.packets_out").inc()
             time.sleep(BROADCAST_INTERVAL)
 
     def listen_for_peers(self):
+        self.own_ip = get_local_ip()
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A listener stopped by a quick off/on toggle holds the port until its next timeout
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(('', BROADCAST_PORT))
+        sock.settimeout(1)  # Wake up regularly to expire silent peers
         while self.running:
-            data, addr = sock.recvfrom(1024)
-            ip = addr[0]
-            if data == DISCOVERY_MESSAGE and ip != self.own_ip:
-                self.on_peer_found(ip)
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.timeout:
+                data, addr = None, None
+            if addr is not None:
+                metrics.counter("discovery.packets_in").inc()
+                ip = addr[0]
+                if data == DISCOVERY_MESSAGE and ip != self.own_ip:
+                    self.last_seen[ip] = time.monotonic()
+                    self.on_peer_found(ip)
+            self.expire_peers()
+            metrics.gauge("discovery.peers").set(len(self.last_seen))
+        sock.close()
+
+    def expire_peers(self):
+        now = time.monotonic()
+        for ip, seen in list(self.last_seen.items()):
+            if now - seen > PEER_TIMEOUT:
+                del self.last_seen[ip]
+                if self.on_peer_lost:
+                    self.on_peer_lost(ip)
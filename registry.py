@@ -0,0 +1,104 @@
+# registry.py
+import threading
+from types import MappingProxyType
+
+
+class PeerSnapshot:
+    """
+    Immutable view of every known peer at one point in time.
+
+    Snapshots are never modified after they are published, so any thread can
+    iterate them without locking. Each one carries the registry version that
+    produced it; a reader that already rendered a version can skip redrawing.
+    """
+    __slots__ = ('version', 'by_id', 'users', '_online')
+
+    def __init__(self, version, by_id):
+        self.version = version
+        self.by_id = MappingProxyType(by_id)  # user id -> read-only user dict
+        self.users = tuple(by_id.values())  # In insertion order
+        self._online = None
+
+    @property
+    def online(self):
+        """Users that are currently online, computed once per snapshot."""
+        if self._online is None:
+            self._online = tuple(user for user in self.users if user['online'])
+        return self._online
+
+
+class PeerRegistry:
+    """
+    Versioned registry of peers with copy-on-write snapshots.
+
+    Writers are serialized by a lock and change a working copy of the peers;
+    publish() turns the pending changes into a new PeerSnapshot with the
+    version incremented. Writes are batched this way because every snapshot
+    copies all peers, so publishing per write would make filling the
+    registry quadratic. Readers only read the current snapshot reference,
+    which is a single atomic attribute load, so the read path never locks.
+    """
+    def __init__(self, users=()):
+        """
+        Parameters:
+            users (iterable): Initial user dictionaries, each with an 'id' key.
+        """
+        self._write_lock = threading.Lock()
+        self._by_id = {user['id']: MappingProxyType(dict(user)) for user in users}
+        self._dirty = False
+        self._snapshot = PeerSnapshot(0, dict(self._by_id))
+
+    @property
+    def snapshot(self):
+        """The latest published snapshot. Lock-free."""
+        return self._snapshot
+
+    def get(self, user_id):
+        """
+        Return a user including writes that are not published yet, or None if unknown.
+        """
+        return self._by_id.get(user_id)
+
+    def add_if_missing(self, user):
+        """
+        Add a user unless one with the same ID is already registered.
+        Visible to snapshot readers after the next publish().
+
+        Returns:
+            Mapping: The stored user if it was added, otherwise None.
+        """
+        with self._write_lock:
+            if user['id'] in self._by_id:
+                return None
+            stored = self._by_id[user['id']] = MappingProxyType(dict(user))
+            self._dirty = True
+            return stored
+
+    def set_online(self, user_id, online):
+        """
+        Change a user's online flag. Visible to snapshot readers after the next publish().
+
+        Returns:
+            Mapping: The updated user, or None if the user is unknown or already had that status.
+        """
+        with self._write_lock:
+            user = self._by_id.get(user_id)
+            if user is None or user['online'] == online:
+                return None
+            updated = self._by_id[user_id] = MappingProxyType({**user, 'online': online})
+            self._dirty = True
+            return updated
+
+    def publish(self):
+        """
+        Publish all writes since the last publish as one new snapshot.
+
+        Returns:
+            PeerSnapshot: The current snapshot, new if anything changed.
+        """
+        with self._write_lock:
+            if self._dirty:
+                # Replacing the reference is atomic for readers
+                self._snapshot = PeerSnapshot(self._snapshot.version + 1, dict(self._by_id))
+                self._dirty = False
+            return self._snapshot
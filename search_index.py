@@ -0,0 +1,164 @@
+# search_index.py
+import bisect
+import heapq
+import threading
+
+MAX_TOKEN_LENGTH = 32  # Longer tokens are only indexed up to this many characters
+
+
+class _TrieNode:
+    __slots__ = ('children', 'ids')
+
+    def __init__(self):
+        self.children = {}
+        self.ids = set()  # IDs of every user with a token starting at this prefix
+
+
+class SearchIndex:
+    """
+    In-memory prefix trie over user names, IP addresses and IDs.
+
+    Every node stores the IDs of the users that have a token with that prefix,
+    so a lookup only walks the query's characters and never scans all users.
+    Users are also kept in display order (name, then ID), so a search that
+    matches many users returns its first page without sorting all of them.
+    Users are added, updated and removed incrementally.
+    """
+    def __init__(self):
+        self.root = _TrieNode()
+        self.tokens = {}  # user id -> tokens currently indexed for that user
+        self.sort_keys = {}  # user id -> (lowercase name, id)
+        self.order = []  # Sorted sort keys of every indexed user
+        self._lock = threading.Lock()  # Discovery threads write while the GUI searches
+
+    def add(self, user):
+        """
+        Index a user, replacing any tokens previously indexed for the same ID.
+
+        Parameters:
+            user (dict): User dictionary with 'id', 'name' and 'ip_address' keys.
+        """
+        user_id = user['id']
+        tokens = self._tokenize(user)
+        with self._lock:
+            old_tokens = self.tokens.get(user_id, set())
+            remaining = set(old_tokens)
+            for token in old_tokens - tokens:
+                remaining.discard(token)
+                self._remove_token(token, user_id, remaining)
+            for token in tokens - old_tokens:
+                self._add_token(token, user_id)
+            self.tokens[user_id] = tokens
+
+            sort_key = (user['name'].lower(), user_id)
+            old_key = self.sort_keys.get(user_id)
+            if old_key != sort_key:
+                if old_key is not None:
+                    self._remove_from_order(old_key)
+                bisect.insort(self.order, sort_key)
+                self.sort_keys[user_id] = sort_key
+
+    def remove(self, user_id):
+        """
+        Remove a user from the index.
+
+        Parameters:
+            user_id (str): ID of the user to remove.
+        """
+        with self._lock:
+            remaining = self.tokens.pop(user_id, set())
+            for token in list(remaining):
+                remaining.discard(token)
+                self._remove_token(token, user_id, remaining)
+            sort_key = self.sort_keys.pop(user_id, None)
+            if sort_key is not None:
+                self._remove_from_order(sort_key)
+
+    def search(self, query, limit=None):
+        """
+        Find users matching every word of the query as a prefix of one of their tokens.
+
+        Parameters:
+            query (str): Search text typed by the user.
+            limit (int): Maximum number of IDs to return, or None for all.
+
+        Returns:
+            list: IDs of the matching users ordered by name, then ID.
+        """
+        with self._lock:
+            id_sets = []
+            for word in query.lower().split():
+                node = self._find(word[:MAX_TOKEN_LENGTH])
+                if node is None or not node.ids:
+                    return []
+                id_sets.append(node.ids)
+            if not id_sets:
+                return [user_id for _, user_id in self.order[:limit]]
+
+            # Test membership against the nodes' own sets instead of copying them
+            id_sets.sort(key=len)
+            smallest, others = id_sets[0], id_sets[1:]
+            # Walking the presorted order finds a page in about limit * users / matches
+            # steps; take it when that is cheaper than sorting every match
+            if limit is not None and len(smallest) ** 2 > limit * len(self.order):
+                matches = []
+                for _, user_id in self.order:
+                    if user_id in smallest and all(user_id in ids for ids in others):
+                        matches.append(user_id)
+                        if len(matches) == limit:
+                            break
+                return matches
+            matches = smallest.intersection(*others) if others else smallest
+            sort_keys = [self.sort_keys[user_id] for user_id in matches]
+            if limit is not None and len(sort_keys) > limit:
+                sort_keys = heapq.nsmallest(limit, sort_keys)
+            else:
+                sort_keys.sort()
+            return [user_id for _, user_id in sort_keys]
+
+    def _remove_from_order(self, sort_key):
+        index = bisect.bisect_left(self.order, sort_key)
+        if index < len(self.order) and self.order[index] == sort_key:
+            del self.order[index]
+
+    def _tokenize(self, user):
+        name = user['name'].lower()
+        tokens = {name, user['id'].lower()}
+        tokens.update(name.split())
+        if user.get('ip_address'):
+            tokens.add(user['ip_address'])
+        return {token[:MAX_TOKEN_LENGTH] for token in tokens if token}
+
+    def _find(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _add_token(self, token, user_id):
+        node = self.root
+        for char in token:
+            node = node.children.setdefault(char, _TrieNode())
+            node.ids.add(user_id)
+
+    def _remove_token(self, token, user_id, remaining):
+        # Another token of the same user may share this prefix, so only drop the
+        # ID from nodes that none of the user's remaining tokens pass through
+        path = []
+        node = self.root
+        for depth, char in enumerate(token):
+            child = node.children.get(char)
+            if child is None:
+                break
+            prefix = token[:depth + 1]
+            if not any(t.startswith(prefix) for t in remaining):
+                child.ids.discard(user_id)
+            path.append((node, char, child))
+            node = child
+        # Prune nodes that no longer lead to any user
+        for parent, char, child in reversed(path):
+            if child.ids or child.children:
+                break
+            del parent.children[char]
@@ -1,14 +1,109 @@
 # logic.py
+import os
 import time
 import random
 import threading
 from models import *
+from search_index import SearchIndex
+from metrics import registry as metrics
+from registry import PeerRegistry
+# asyncio (connections), hashlib (delivery), sqlite3 (database) and sync are imported
+# where they are first used, so none of them delays the GUI's first frame
+
+FRAME_INTERVAL = 1 / 30  # seconds between peer change deliveries to the UI
+CONNECT_TIMEOUT = 10  # seconds before a connection attempt gives up
+LOCAL_USER_ID = 'me'  # sender_id used for messages written on this device
+SEARCH_RESULT_LIMIT = 200  # matches returned per search; more than the chat list shows at once
+PENDING_LIMIT = 1000  # out-of-order messages held per peer; history sync recovers the rest
+
+
+class PeerChangeBatcher:
+    """
+    Collects peer add/remove/change events from discovery threads and delivers
+    them as a single PeerChanges diff at most once per frame interval.
+    """
+    def __init__(self, deliver, interval=FRAME_INTERVAL):
+        self.deliver = deliver
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._added = {}
+        self._removed = {}
+        self._changed = {}
+        self._timer = None
+        self._last_flush = 0.0
+
+    def record(self, kind, user):
+        """
+        Record a peer event, coalescing it with any pending event for the same peer.
+
+        Parameters:
+            kind (str): One of 'added', 'removed' or 'changed'.
+            user (dict): The peer's current user dictionary.
+        """
+        peer_id = user['id']
+        with self._lock:
+            if kind == 'added':
+                if self._removed.pop(peer_id, None) is not None:
+                    self._changed[peer_id] = user  # Came back before the UI saw it leave
+                else:
+                    self._added[peer_id] = user
+            elif kind == 'changed':
+                if peer_id in self._added:
+                    self._added[peer_id] = user
+                else:
+                    self._changed[peer_id] = user
+            elif kind == 'removed':
+                if self._added.pop(peer_id, None) is None:
+                    self._changed.pop(peer_id, None)
+                    self._removed[peer_id] = user
+            else:
+                raise ValueError(f"Unknown peer change kind: {kind}")
+
+            if self._timer is None:
+                delay = max(0.0, self._last_flush + self.interval - time.monotonic())
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Deliver all pending changes as one PeerChanges diff."""
+        with self._lock:
+            changes = PeerChanges(
+                added=list(self._added.values()),
+                removed=list(self._removed.values()),
+                changed=list(self._changed.values()),
+            )
+            self._added, self._removed, self._changed = {}, {}, {}
+            self._timer = None
+            self._last_flush = time.monotonic()
+        if changes:
+            self.deliver(changes)
+
 
 class ChatService:
-    def __init__(self, ui_callback):
+    def __init__(self, ui_callback, db=None, node_id=None):
+        """
+        Parameters:
+            ui_callback (callable): Receives events (ConnectionSuccess, PeerChanges, NewMessage, ...) from any thread.
+            db (DatabaseManagement): Optional store that users and messages are persisted to.
+            node_id (str): Identifier of this device used in message ids; random if not given.
+        """
         self.ui_callback = ui_callback
+        self.db = db
+        self.node_id = node_id or os.urandom(6).hex()
+        self._message_ids = None  # Created on first use, see _get_or_create
+        self._dedup = None
+        self._connections = None
+        self._create_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._history_loaded = set()  # IDs of users whose stored messages are in memory
+        self._history_lock = threading.Lock()
+        self._receive_lock = threading.Lock()  # Keeps each peer's messages stored in seq order
+        self._pending = {}  # peer id -> {seq: (message id, content)} held back by a gap
         self.discovery = None  # Not started by default
-        self.users = {
+        self.peer_changes = PeerChangeBatcher(deliver=self._deliver_peer_changes)
+        self.local_ip = None  # Filled in by resolve_local_ip
+        sample_users = {
             '1': User('1', 'Alice', True, '192.168.1.2', 5000, 'KEY123'),
             '2': User('2', 'Bob', False, '192.168.1.3', 5001, 'KEY456'),
             '3': User('3', 'Charlie', True, '192.168.1.4', 5002, 'KEY789'),
@@ -25,10 +120,65 @@ class ChatService:
             '14': User('14', 'Peggy', True, '192.168.1.15', 5013, 'KEY654B'),
             '15': User('15', 'Sybil', False, '192.168.1.16', 5014, 'KEY789C'),
         }
+        if self.db is not None:
+            for user_id, name, online, ip_address, port, connection_key in self.db.get_all_users():
+                sample_users[user_id] = User(user_id, name, bool(online), ip_address, port, connection_key)
+
+        # Written only through the registry and published once per batch of peer changes;
+        # readers take lock-free snapshots
+        self.peers = PeerRegistry(user.to_dict() for user in sample_users.values())
+        self.messages = {}  # user id -> list of Message
+
+        self.search_index = SearchIndex()
+        for user in self.peers.snapshot.users:
+            self.search_index.add(user)
+
+    @property
+    def message_ids(self):
+        """MessageIdGenerator for messages written on this device."""
+        from delivery import MessageIdGenerator
+        return self._get_or_create('_message_ids', lambda: MessageIdGenerator(self.node_id))
+
+    @property
+    def dedup(self):
+        """MessageDeduplicator that drops redelivered inbound messages."""
+        from delivery import MessageDeduplicator
+        return self._get_or_create('_dedup', lambda: MessageDeduplicator(is_stored=self._is_stored))
+
+    @property
+    def connections(self):
+        """ConnectionManager running connection attempts on its asyncio loop."""
+        from connections import ConnectionManager
+        return self._get_or_create('_connections', lambda: ConnectionManager(on_result=self.ui_callback))
+
+    def _get_or_create(self, attribute, create):
+        # Helpers that only messaging and connecting need are built on first use,
+        # once by whichever thread gets there first
+        value = getattr(self, attribute)
+        if value is None:
+            with self._create_lock:
+                value = getattr(self, attribute)
+                if value is None:
+                    value = create()
+                    setattr(self, attribute, value)
+        return value
+
+    def resolve_local_ip(self):
+        """
+        Detect the local address on a background thread and report it as a LocalAddress event.
+        """
+        from peer_discovery import get_local_ip  # Avoid circular import
+
+        def resolve():
+            self.local_ip = get_local_ip()
+            self.ui_callback(LocalAddress(self.local_ip))
+
+        threading.Thread(target=resolve, daemon=True).start()
+
     def start_discovery(self):
         from peer_discovery import PeerDiscovery  # Avoid circular import
         if self.discovery is None:
-            self.discovery = PeerDiscovery(on_peer_found=self.add_peer)
+            self.discovery = PeerDiscovery(on_peer_found=self.add_peer, on_peer_lost=self.remove_peer)
             self.discovery.start()
 
     def stop_discovery(self):
@@ -37,38 +187,240 @@ class ChatService:
             self.discovery = None
 
     def add_peer(self, ip):
-        if ip not in self.users:
-            peer_id = ip
-            name = f"Peer {ip.split('.')[-1]}"
-            user = User(user_id=peer_id, name=name, online=True, ip_address=ip, port=5000, connection_key="KEY")
-            self.users[peer_id] = user
-            self.ui_callback('peer_discovered')  # Tell GUI to refresh
+        peer_id = ip
+        name = f"Peer {ip.split('.')[-1]}"
+        user = User(user_id=peer_id, name=name, online=True, ip_address=ip, port=5000, connection_key="KEY").to_dict()
+        added = self.peers.add_if_missing(user)
+        if added is not None:
+            self.search_index.add(added)
+            self._persist_user(added)
+            self.peer_changes.record('added', dict(added))
+            return
+
+        updated = self.peers.set_online(peer_id, True)
+        if updated is not None:
+            self._persist_status(updated)
+            self.peer_changes.record('changed', dict(updated))
+
+    def remove_peer(self, ip):
+        updated = self.peers.set_online(ip, False)
+        if updated is not None:
+            self._persist_status(updated)
+            self.peer_changes.record('removed', dict(updated))
+
+    def _deliver_peer_changes(self, changes):
+        # One snapshot per batch of peer changes, published before the UI reads it
+        self.peers.publish()
+        self.ui_callback(changes)
 
     def run(self):
-        # Placeholder thread runner
-        while True:
-            time.sleep(1)
+        """
+        Keep the service alive until stop() is called.
+        Discovery and connection attempts run on their own threads.
+        """
+        self._stop_event.wait()
+
+    def stop(self):
+        """
+        Stop discovery, cancel pending connection attempts and let run() return.
+        """
+        self.stop_discovery()
+        if self._connections is not None:
+            self._connections.close()
+        self._stop_event.set()
+
+    def _persist_user(self, user):
+        if self.db is not None:
+            self.db.add_or_update_user({
+                'user_id': user['id'],
+                'name': user['name'],
+                'online': user['online'],
+                'ip_address': user['ip_address'],
+                'port': user['port'],
+                'connection_key': user['connection_key'],
+            })
+
+    def _persist_status(self, user):
+        if self.db is not None:
+            self.db.update_user_status(user['id'], user['online'])
+
+    def _messages(self, user_id):
+        # Stored history is read once per user, the first time it is needed
+        if self.peers.get(user_id) is None:
+            raise KeyError(user_id)
+        messages = self.messages.setdefault(user_id, [])
+        if self.db is not None and user_id not in self._history_loaded:
+            with self._history_lock:
+                if user_id not in self._history_loaded:
+                    stored = [Message(sender_id=row[1], content=row[3]) for row in self.db.get_conversation(LOCAL_USER_ID, user_id)]
+                    messages[:0] = stored
+                    self._history_loaded.add(user_id)
+        return messages
+
+    def get_peer_snapshot(self):
+        """
+        Return the current immutable PeerSnapshot. Its version changes whenever any peer changes.
+        """
+        return self.peers.snapshot
 
     def get_users(self):
-        return [user.to_dict() for user in self.users.values()]
+        return list(self.peers.snapshot.users)
 
-    def fetch_messages(self, user_id):
-        return [{'from': msg.sender_id, 'message': msg.content} for msg in self.users[user_id].messages]
+    def search_users(self, query, limit=SEARCH_RESULT_LIMIT):
+        """
+        Return users whose name, IP address or ID has a word starting with each word of the query,
+        ordered by name and capped at limit so the result stays cheap to build on the UI thread.
+        """
+        matches = (self.peers.get(user_id) for user_id in self.search_index.search(query, limit))
+        return [user for user in matches if user is not None]
+
+    def fetch_messages(self, user_id, start=0):
+        # start lets the UI fetch only messages it has not rendered yet
+        return [{'from': msg.sender_id, 'message': msg.content} for msg in self._messages(user_id)[start:]]
 
     def send_message(self, user_id, message):
-        msg = Message(sender_id='me', content=message)
-        self.users[user_id].messages.append(msg)
-        self.users[user_id].messages.append(Message(sender_id=user_id, content=f"Echo: {message}"))
+        with metrics.time("service.send_message"):
+            self._send_message(user_id, message)
+
+    def _send_message(self, user_id, message):
+        messages = self._messages(user_id)
+        msg = Message(sender_id=LOCAL_USER_ID, content=message, message_id=self.message_ids.next())
+        messages.append(msg)
+        metrics.counter("service.messages_sent").inc()
+        self.ui_callback(NewMessage(user_id, msg))
+        if self.db is not None:
+            self.db.send_message(LOCAL_USER_ID, user_id, msg.content, uid=msg.message_id)
+        # Stand-in for the peer's reply until a real transport exists
+        self.receive_message(user_id, self.message_ids.next(), f"Echo: {message}")
+
+    def receive_message(self, user_id, message_id, content, seq=None):
+        with metrics.time("service.receive_message"):
+            return self._receive_message(user_id, message_id, content, seq)
+
+    def _receive_message(self, user_id, message_id, content, seq=None):
+        """
+        Deliver an inbound message exactly once and in order. Redeliveries of a
+        message id that was already received are dropped. A message that
+        arrives ahead of a missing one is held back until the missing one
+        arrives or history sync fills the gap.
+
+        Parameters:
+            user_id (str): ID of the sending peer.
+            message_id (str): Globally unique id the sender gave the message.
+            content (str): Text content of the message.
+            seq (int): The sender's seq for the message, as carried on the wire.
+                None assigns the next local seq (peers that do not send one).
+
+        Returns:
+            bool: True if the message was new and delivered.
+        """
+        from database import RECEIVE_STORED, RECEIVE_DUPLICATE, RECEIVE_GAP
+        if self.dedup.check_and_add(message_id):
+            metrics.counter("service.duplicates_dropped").inc()
+            return False
+        if self.db is None:
+            self._deliver(user_id, message_id, content)
+            return True
+
+        # Load stored history first, or the message would be read back and appended twice
+        self._messages(user_id)
+        with self._receive_lock:
+            result = self.db.receive_message(message_id, user_id, LOCAL_USER_ID, content, seq)
+            if result == RECEIVE_STORED:
+                self._deliver(user_id, message_id, content)
+                self._drain_pending(user_id)
+                return True
+            if result == RECEIVE_DUPLICATE:
+                # Already stored, e.g. redelivered after the filter forgot the id
+                metrics.counter("service.duplicates_dropped").inc()
+                return False
+            # Not stored: let the redelivery through the filter
+            self.dedup.forget(message_id)
+            if result == RECEIVE_GAP:
+                pending = self._pending.setdefault(user_id, {})
+                if len(pending) < PENDING_LIMIT:
+                    pending[seq] = (message_id, content)
+                metrics.counter("service.messages_held").inc()
+            return False
+
+    def _deliver(self, user_id, message_id, content):
+        msg = Message(sender_id=user_id, content=content, message_id=message_id)
+        self._messages(user_id).append(msg)
+        metrics.counter("service.messages_received").inc()
+        self.ui_callback(NewMessage(user_id, msg))
+
+    def _drain_pending(self, user_id):
+        """
+        Store held-back messages from a peer that are now next in order.
+        Called with the receive lock held.
+        """
+        from database import RECEIVE_STORED, RECEIVE_GAP, RECEIVE_FAILED
+        pending = self._pending.get(user_id)
+        while pending:
+            seq = min(pending)
+            message_id, content = pending[seq]
+            result = self.db.receive_message(message_id, user_id, LOCAL_USER_ID, content, seq)
+            if result in (RECEIVE_GAP, RECEIVE_FAILED):
+                break
+            del pending[seq]
+            if result == RECEIVE_STORED:
+                self.dedup.add(message_id)
+                self._deliver(user_id, message_id, content)
+        if not pending:
+            self._pending.pop(user_id, None)
+
+    def _is_stored(self, message_id):
+        # Without a database there is nothing to confirm against; prefer a rare
+        # duplicate over dropping a message on a Bloom filter false positive
+        return self.db is not None and self.db.message_exists(message_id)
+
+    def history_sync(self, peer_id):
+        """
+        Return the HistorySync used to reconcile the conversation with a peer on reconnect.
+        """
+        if self.db is None:
+            raise RuntimeError("History sync needs a database")
+        from sync import HistorySync
+        return HistorySync(self.db, LOCAL_USER_ID, peer_id)
+
+    def apply_sync_batch(self, peer_id, batch):
+        """
+        Store a sync batch received from a peer and drop the cached history so it is re-read in order.
+
+        Returns:
+            int: Number of messages that were new.
+        """
+        inserted = self.history_sync(peer_id).apply(batch)
+        with self._receive_lock:
+            # Held-back messages are now either stored by the batch or next in order
+            self._drain_pending(peer_id)
+        if inserted:
+            with self._history_lock:
+                self._history_loaded.discard(peer_id)
+                self.messages.pop(peer_id, None)
+        return inserted
 
     def get_discovered_peers(self):
-        return [user.to_dict() for user in self.users.values() if user.online]
+        return list(self.peers.snapshot.online)
 
     def get_connection_code(self, peer_id):
-        return self.users[peer_id].connection_key
+        return self.peers.snapshot.by_id[peer_id]['connection_key']
+
+    def connect_to_peer(self, peer_id, timeout=CONNECT_TIMEOUT):
+        """
+        Start a connection attempt without blocking. The result is reported
+        through ui_callback unless the attempt is cancelled first.
+
+        Returns:
+            ConnectionHandle: Handle the caller can cancel or wait on.
+        """
+        return self.connections.connect(peer_id, self._connect, timeout)
 
-    def connect_to_peer(self, peer_id):
-        time.sleep(2)
+    async def _connect(self, peer_id):
+        import asyncio
+        metrics.counter("service.connect_attempts").inc()
+        await asyncio.sleep(2)
         if random.choice([True, False]):
-            self.ui_callback(ConnectionSuccess(self.users[peer_id].to_dict()))
+            return ConnectionSuccess(dict(self.peers.snapshot.by_id[peer_id]))
         else:
-            self.ui_callback(ConnectionFailure("Peer not responding"))
+            return ConnectionFailure("Peer not responding", peer_id=peer_id)
@@ -0,0 +1,97 @@
+# sync.py
+"""
+Incremental history sync between two peers.
+
+Every stored message has a seq that counts its sender's messages to one
+receiver, so each direction of a conversation is a gapless 1, 2, 3, ...
+sequence. Live messages carry the sender's seq and are held back until every
+earlier one is stored (ChatService.receive_message), so a message lost in
+transit never hides behind a later one. On reconnect both sides exchange
+high-water marks (the highest seq they hold per direction) and then stream
+only the messages above the other side's marks:
+
+    a = HistorySync(db_a, 'me', 'peer-b')      b = HistorySync(db_b, 'me', 'peer-a')
+    hello_a = a.hello()                         hello_b = b.hello()
+    for batch in a.batches_for(hello_b):        for batch in b.batches_for(hello_a):
+        send(batch)  ->  b.apply(batch)             send(batch)  ->  a.apply(batch)
+
+Senders are described relative to the side that builds the message ("mine" or
+"yours"), so peers never need to agree on what each one calls itself locally.
+"""
+
+SYNC_BATCH_SIZE = 500  # messages per sync batch
+
+
+class HistorySync:
+    """
+    One side of a history reconciliation for the conversation between the
+    local user and a peer.
+    """
+    def __init__(self, db, local_id, peer_id, batch_size=SYNC_BATCH_SIZE):
+        """
+        Parameters:
+            db (DatabaseManagement): Local message store.
+            local_id (str): ID the local user's messages are stored under.
+            peer_id (str): ID the peer's messages are stored under.
+            batch_size (int): Maximum messages per batch.
+        """
+        self.db = db
+        self.local_id = local_id
+        self.peer_id = peer_id
+        self.batch_size = batch_size
+
+    def hello(self):
+        """
+        Build the advertisement sent to the peer when the connection opens.
+
+        Returns:
+            dict: {'type': 'sync_hello', 'mine': <highest seq we sent>, 'yours': <highest seq of theirs we hold>}
+        """
+        marks = self.db.get_high_water_marks(self.local_id, self.peer_id)
+        return {'type': 'sync_hello', 'mine': marks[self.local_id], 'yours': marks[self.peer_id]}
+
+    def batches_for(self, remote_hello):
+        """
+        Yield batches with every message the peer is missing according to its hello.
+
+        Parameters:
+            remote_hello (dict): The peer's sync_hello message.
+
+        Yields:
+            dict: {'type': 'sync_batch', 'messages': [...]} with at most batch_size messages.
+        """
+        # The peer's "yours" is how far it has our messages; its "mine" is how far
+        # it has its own, which we may hold if it lost history
+        directions = (
+            (self.local_id, self.peer_id, 'mine', remote_hello.get('yours', 0)),
+            (self.peer_id, self.local_id, 'yours', remote_hello.get('mine', 0)),
+        )
+        for sender_id, receiver_id, sender, after_seq in directions:
+            for rows in self.db.iter_messages_after(sender_id, receiver_id, after_seq, self.batch_size):
+                yield {
+                    'type': 'sync_batch',
+                    'messages': [
+                        {'sender': sender, 'seq': seq, 'uid': uid, 'content': content, 'timestamp': timestamp}
+                        for _, _, content, timestamp, seq, uid in rows
+                    ],
+                }
+
+    def apply(self, batch):
+        """
+        Store a batch received from the peer in one transaction.
+
+        Parameters:
+            batch (dict): A sync_batch message built by the peer.
+
+        Returns:
+            int: Number of messages that were new.
+        """
+        rows = []
+        for message in batch['messages']:
+            # "mine" in the peer's batch means the peer sent it
+            if message['sender'] == 'mine':
+                sender_id, receiver_id = self.peer_id, self.local_id
+            else:
+                sender_id, receiver_id = self.local_id, self.peer_id
+            rows.append((sender_id, receiver_id, message['content'], message['timestamp'], message['seq'], message.get('uid')))
+        return self.db.insert_messages_bulk(rows)
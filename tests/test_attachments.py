@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attachments import AttachmentStore
+from database import DatabaseManagement
+
+
+class AttachmentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = DatabaseManagement(os.path.join(self.tmp.name, "test.db"))
+        self.store = AttachmentStore(self.db, os.path.join(self.tmp.name, "attachments"), chunk_size=4)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_file(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_documented_read_pattern(self):
+        attachment_hash = self.store.put(self.write_file("a.bin", b"0123456789"))
+        received = b""
+        with self.store.open(attachment_hash) as reader:
+            for view in reader.chunks():
+                received += bytes(view)
+        # The last view is still referenced here; closing must not fail because of it
+        self.assertEqual(received, b"0123456789")
+        with self.assertRaises(ValueError):
+            bytes(view)
+
+    def test_release_hook_keeps_chunks_recorded_again(self):
+        attachment_hash = self.store.put(self.write_file("a.bin", b"aaaabbbb"))
+        chunk_hashes = [chunk_hash for chunk_hash, _ in self.db.get_attachment_chunks(attachment_hash)]
+        # A late release hook for chunks a put() has recorded again must not remove them
+        self.store.delete_chunks(chunk_hashes)
+        with self.store.open(attachment_hash) as reader:
+            self.assertEqual(reader.read(0, 8), b"aaaabbbb")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+# widgets.py
+import functools
+import math
+import tkinter as tk
+import customtkinter as ctk
+
+
+def bind_mousewheel(widget, canvas):
+    """
+    Scroll the canvas with the mouse wheel while the pointer is over the widget.
+    Binds the underlying Tk widgets so CTk's compound widgets scroll too.
+    """
+    tk.Misc.bind(widget, "<MouseWheel>", lambda e: canvas.yview_scroll(-1 if e.delta > 0 else 1, "units"), "+")
+    tk.Misc.bind(widget, "<Button-4>", lambda e: canvas.yview_scroll(-1, "units"), "+")
+    tk.Misc.bind(widget, "<Button-5>", lambda e: canvas.yview_scroll(1, "units"), "+")
+    for child in widget.winfo_children():
+        bind_mousewheel(child, canvas)
+
+
+class VirtualList(ctk.CTkFrame):
+    """
+    Scrollable list that only creates enough row widgets to fill the viewport.
+    Rows are recycled while scrolling: each visible slot is moved to its item's
+    position and refreshed in place through the bind_row callback.
+    """
+    def __init__(self, master, row_height, create_row, bind_row, bg_color="#2b2b2b", **kwargs):
+        """
+        Parameters:
+            master: Parent widget.
+            row_height (int): Fixed height of every row in pixels.
+            create_row (callable): Called with the parent canvas, returns a new row widget.
+            bind_row (callable): Called with (row, item) to show an item in a row.
+        """
+        super().__init__(master, fg_color=bg_color, **kwargs)
+        self.row_height = row_height
+        self.create_row = create_row
+        self.bind_row = bind_row
+        self.items = []
+        self.rows = []  # Pooled (row widget, canvas window id) pairs
+        self.bound = []  # Item index currently shown by each pooled row
+
+        self.canvas = tk.Canvas(self, bg=bg_color, highlightthickness=0, yscrollincrement=max(1, row_height // 4))
+        self.scrollbar = ctk.CTkScrollbar(self, orientation="vertical", command=self.canvas.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.canvas.configure(yscrollcommand=self._on_scroll)
+
+        self.canvas.bind("<Configure>", self._on_resize)
+        bind_mousewheel(self.canvas, self.canvas)
+
+    def set_items(self, items):
+        """Replace the list contents and redraw the visible rows."""
+        self.items = items
+        self.bound = [None] * len(self.rows)
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), len(items) * self.row_height))
+        self.canvas.yview_moveto(0)
+        self._layout()
+
+    def refresh(self):
+        """Re-bind all visible rows, e.g. after items were updated in place."""
+        self.bound = [None] * len(self.rows)
+        self._layout()
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self._layout()
+
+    def _on_resize(self, event):
+        self.canvas.configure(scrollregion=(0, 0, event.width, len(self.items) * self.row_height))
+        for row, window_id in self.rows:
+            self.canvas.itemconfigure(window_id, width=event.width)
+        self._ensure_pool(event.height)
+        self._layout()
+
+    def _ensure_pool(self, viewport_height):
+        # One extra row covers the partially visible row at the bottom
+        needed = math.ceil(viewport_height / self.row_height) + 1
+        while len(self.rows) < needed:
+            row = self.create_row(self.canvas)
+            bind_mousewheel(row, self.canvas)
+            window_id = self.canvas.create_window(
+                (0, -self.row_height), window=row, anchor="nw",
+                width=self.canvas.winfo_width(), height=self.row_height
+            )
+            self.rows.append((row, window_id))
+            self.bound.append(None)
+
+    def _layout(self):
+        if not self.rows:
+            return
+        first_index = max(0, int(self.canvas.canvasy(0) // self.row_height))
+        pool_size = len(self.rows)
+        for index in range(first_index, first_index + pool_size):
+            # Each item always lands in the same slot, so scrolling by one row rebinds one row
+            slot = index % pool_size
+            row, window_id = self.rows[slot]
+            if index < len(self.items):
+                self.canvas.coords(window_id, 0, index * self.row_height)
+                if self.bound[slot] != index:
+                    self.bind_row(row, self.items[index])
+                    self.bound[slot] = index
+            else:
+                # Park unused rows above the scroll region
+                self.canvas.coords(window_id, 0, -self.row_height)
+                self.bound[slot] = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(size, weight="normal"):
+    """
+    Return a shared CTkFont for the given size and weight, creating it on first use.
+    Must be called after the root window exists.
+    """
+    return ctk.CTkFont(size=size, weight=weight)
+
+
+class ChatHistory(ctk.CTkFrame):
+    """
+    Scrollable chat history that keeps its rendered bubbles between updates.
+    New messages are appended at the bottom; only the most recent window of
+    messages is rendered, older bubbles are created as the user scrolls up to
+    them and dropped again when new messages arrive.
+    """
+    def __init__(self, master, peer_id, window=50, bg_color="#2b2b2b", **kwargs):
+        """
+        Parameters:
+            master: Parent widget.
+            peer_id (str): ID of the chat partner; their messages are shown on the left.
+            window (int): Number of bubbles rendered initially and per scroll-up step.
+        """
+        super().__init__(master, fg_color=bg_color, corner_radius=10, **kwargs)
+        self.peer_id = peer_id
+        self.window = window
+        self.messages = []
+        self.first_rendered = 0  # Index of the oldest message that has a bubble
+        self._loading_older = False
+
+        self.canvas = tk.Canvas(self, bg=bg_color, highlightthickness=0)
+        self.scrollbar = ctk.CTkScrollbar(self, orientation="vertical", command=self.canvas.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.canvas.configure(yscrollcommand=self._on_scroll)
+
+        self.inner = ctk.CTkFrame(self.canvas, fg_color=bg_color)
+        self.window_id = self.canvas.create_window((0, 0), window=self.inner, anchor="nw")
+        self.inner.bind("<Configure>", lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
+        self.canvas.bind("<Configure>", lambda e: self.canvas.itemconfigure(self.window_id, width=e.width))
+        bind_mousewheel(self.canvas, self.canvas)
+
+    def append(self, messages):
+        """
+        Add new messages to the end of the history and scroll to the bottom.
+
+        Parameters:
+            messages (list): Message dictionaries with 'from' and 'message' keys.
+        """
+        if not messages:
+            return
+        self.messages.extend(messages)
+        if len(messages) >= self.window:
+            # First load or a large batch: skip straight to the most recent window
+            for bubble in self.inner.pack_slaves():
+                bubble.destroy()
+            self.first_rendered = len(self.messages) - self.window
+            new = self.messages[self.first_rendered:]
+        else:
+            new = messages
+        for msg in new:
+            self._make_bubble(msg).pack(anchor=self._side(msg), padx=10, pady=4)
+        self._trim_oldest()
+        self.canvas.update_idletasks()
+        self.canvas.yview_moveto(1.0)
+
+    def _trim_oldest(self):
+        # The view jumps to the bottom, so bubbles beyond the recent window are
+        # off screen; drop them and let _load_older rebuild them on scroll-up
+        excess = len(self.messages) - self.first_rendered - self.window
+        if excess <= 0:
+            return
+        for bubble in self.inner.pack_slaves()[:excess]:
+            bubble.destroy()
+        self.first_rendered += excess
+
+    def _load_older(self):
+        self._loading_older = False
+        if self.first_rendered == 0:
+            return
+        start = max(0, self.first_rendered - self.window)
+        anchor_bubble = self.inner.pack_slaves()[0]
+        old_height = self.inner.winfo_height()
+        for msg in self.messages[start:self.first_rendered]:
+            self._make_bubble(msg).pack(anchor=self._side(msg), padx=10, pady=4, before=anchor_bubble)
+        self.first_rendered = start
+
+        # Keep the previously visible bubbles where they were on screen
+        self.canvas.update_idletasks()
+        new_height = self.inner.winfo_height()
+        if new_height > 0:
+            self.canvas.yview_moveto((new_height - old_height) / new_height)
+
+    def _side(self, msg):
+        return "w" if msg['from'] == self.peer_id else "e"
+
+    def _make_bubble(self, msg):
+        is_from_peer = msg['from'] == self.peer_id
+        bubble = ctk.CTkLabel(
+            self.inner,
+            text=msg['message'],
+            anchor=self._side(msg),
+            justify="left",
+            wraplength=500,
+            font=get_font(13),
+            text_color="white",
+            fg_color="#34495e" if is_from_peer else "#16a085",
+            corner_radius=12,
+            padx=10,
+            pady=6
+        )
+        bind_mousewheel(bubble, self.canvas)
+        return bubble
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if float(first) <= 0.0 and self.first_rendered > 0 and not self._loading_older:
+            # Defer so the scroll that got us here finishes first
+            self._loading_older = True
+            self.after_idle(self._load_older)